@@ -0,0 +1,312 @@
+import os
+import numpy as np
+
+from tqdm import tqdm
+
+
+INDEX_TYPES = ['ivf', 'hnsw']
+
+
+def default_nprobe(nlist):
+    """Scan about a tenth of the lists (at least 8) per query"""
+    return min(nlist, max(8, nlist // 10))
+
+
+def topk_merge(scores, ids, new_scores, new_ids, k):
+    """Merge two sets of per-row candidates and keep the k highest scores
+
+    Args:
+        scores (np.ndarray): the current scores (n_rows, k)
+        ids (np.ndarray): the current indices (n_rows, k)
+        new_scores (np.ndarray): the new scores (n_rows, m)
+        new_ids (np.ndarray): the new indices (n_rows, m)
+        k (int): the number of candidates to keep
+
+    Returns:
+        np.ndarray: the merged scores (n_rows, k)
+        np.ndarray: the merged indices (n_rows, k)
+    """
+    scores = np.concatenate([scores, new_scores], axis=1)
+    ids = np.concatenate([ids, new_ids], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    return scores, ids
+
+
+class IVFIndex:
+    """An inverted file index for cosine (inner product) search
+
+    The vectors are clustered with spherical k-means into nlist lists; a
+    query only scans the nprobe lists whose centroids are the most similar,
+    so the cost per query is about nprobe / nlist of the exact search.
+
+    Args:
+        centroids (np.ndarray): the (nlist, dim) centroids
+        list_offsets (np.ndarray): the (nlist + 1,) offsets of each list in ids
+        ids (np.ndarray): the indexed row numbers, grouped by list
+        nprobe (int, optional): the number of lists scanned per query
+            (default: default_nprobe(nlist))
+    """
+
+    def __init__(self, centroids, list_offsets, ids, nprobe=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.nprobe = nprobe or default_nprobe(len(centroids))
+
+    @classmethod
+    def build(cls, mat, nlist=None, n_iter=10, nprobe=None, seed=0, batch_size=8192,
+              points_per_list=64):
+        """Cluster the (normalized) rows of mat and build the inverted lists
+
+        Points are assigned to the centroids batch_size rows at a time, so the
+        memory stays bounded by batch_size * nlist similarities.
+
+        Args:
+            mat (np.ndarray or EmbeddingMatrix): the (n, dim) matrix to index
+            nlist (int, optional): the number of lists (default: sqrt(n))
+            n_iter (int, optional): the number of k-means iterations
+            nprobe (int, optional): the number of lists scanned per query
+                (default: default_nprobe(nlist))
+            seed (int, optional): the random seed
+            batch_size (int, optional): the rows assigned per step
+            points_per_list (int, optional): the k-means training points per list
+
+        Returns:
+            IVFIndex: the index
+        """
+        n = len(mat)
+        nlist = nlist or max(1, int(np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.RandomState(seed)
+
+        # k-means on a sample of at most points_per_list points per list
+        sample = np.asarray(mat[np.sort(rng.choice(n, min(n, nlist * points_per_list), replace=False))],
+                            dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(n_iter):
+            sums = np.zeros_like(centroids)
+            for start in range(0, len(sample), batch_size):
+                block = sample[start:start+batch_size]
+                assign = np.argmax(block @ centroids.T, axis=1)
+                order = np.argsort(assign, kind='stable')
+                lists, first = np.unique(assign[order], return_index=True)
+                sums[lists] += np.add.reduceat(block[order], first, axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty lists keep their previous centroid
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+        assign = np.empty(n, dtype=np.int64)
+        for start in range(0, n, batch_size):
+            block = np.asarray(mat[start:start+batch_size], dtype=np.float32)
+            assign[start:start+len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        ids = np.argsort(assign, kind='stable')
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+        return cls(centroids.astype(np.float32), list_offsets, ids, nprobe=nprobe)
+
+    def save(self, path):
+        with open(path, 'wb') as fout:
+            np.savez(fout, centroids=self.centroids, list_offsets=self.list_offsets, ids=self.ids)
+
+    @classmethod
+    def load(cls, path, nprobe=None):
+        arrays = np.load(path)
+        return cls(arrays['centroids'], arrays['list_offsets'], arrays['ids'], nprobe=nprobe)
+
+    def search(self, mat, queries, k=None, threshold=None):
+        """Search the indexed rows of mat for a batch of queries
+
+        Args:
+            mat (np.ndarray or EmbeddingMatrix): the indexed matrix
+            queries (np.ndarray): the (n_queries, dim) query vectors
+            k (int, optional): return the top-k rows per query
+            threshold (float, optional): return the rows of similarity >= threshold
+
+        Returns:
+            np.ndarray: the row indices in mat
+            np.ndarray: the query indices
+            np.ndarray: the similarities
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nq = len(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe]
+
+        if k is not None:
+            best_scores = np.full((nq, k), -np.inf, dtype=np.float32)
+            best_ids = np.full((nq, k), -1, dtype=np.int64)
+        found = []
+
+        # scan each probed list once for all the queries probing it
+        for lst in np.unique(probes):
+            qs = np.flatnonzero((probes == lst).any(axis=1))
+            rows = self.ids[self.list_offsets[lst]:self.list_offsets[lst+1]]
+            if len(rows) == 0:
+                continue
+            sims = queries[qs] @ np.asarray(mat[rows], dtype=np.float32).T
+            if k is not None:
+                best_scores[qs], best_ids[qs] = topk_merge(best_scores[qs], best_ids[qs], sims,
+                                                           np.broadcast_to(rows, sims.shape), k)
+            else:
+                q_idx, r_idx = np.nonzero(sims >= threshold)
+                found.append((rows[r_idx], qs[q_idx], sims[q_idx, r_idx]))
+
+        if k is not None:
+            valid = best_ids >= 0
+            return best_ids[valid], np.nonzero(valid)[0], best_scores[valid]
+        if not found:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return tuple(np.concatenate(x) for x in zip(*found))
+
+
+class HNSWIndex:
+    """A faiss HNSW index for inner product search (requires faiss-cpu)."""
+
+    def __init__(self, index, ef_search=64):
+        self.index = index
+        self.index.hnsw.efSearch = ef_search
+
+    @classmethod
+    def build(cls, mat, m=32, ef_search=64, batch_size=65536):
+        faiss = _import_faiss()
+        index = faiss.IndexHNSWFlat(mat.shape[1], m, faiss.METRIC_INNER_PRODUCT)
+        for start in range(0, len(mat), batch_size):
+            index.add(np.ascontiguousarray(mat[start:start+batch_size], dtype=np.float32))
+        return cls(index, ef_search=ef_search)
+
+    def save(self, path):
+        _import_faiss().write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path, ef_search=64):
+        return cls(_import_faiss().read_index(path), ef_search=ef_search)
+
+    def search(self, mat, queries, k=None, threshold=None):
+        if k is None:
+            raise ValueError("the hnsw index only supports top-k search")
+        scores, ids = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        valid = ids >= 0
+        return ids[valid].astype(np.int64), np.nonzero(valid)[0], scores[valid]
+
+
+def _import_faiss():
+    try:
+        import faiss
+    except ImportError:
+        raise ImportError("the hnsw index requires faiss (pip install faiss-cpu)")
+    return faiss
+
+
+def load_or_build_index(mat_fn, mat, index_type='ivf', nlist=None, nprobe=None, rebuild=False):
+    """Load the index persisted next to a .mat file, (re)building it when stale
+
+    The index is stored as <mat_fn>.<index_type> and rebuilt when it is
+    older than the .mat file.
+
+    Args:
+        mat_fn (str): the path of the encoded vectors
+        mat (np.ndarray or EmbeddingMatrix): the encoded vectors
+        index_type (str, optional): one of INDEX_TYPES
+        nlist (int, optional): the number of IVF lists
+        nprobe (int, optional): the number of IVF lists scanned per query
+            (default: default_nprobe(nlist))
+        rebuild (boolean, optional): whether to rebuild the index anyway
+
+    Returns:
+        IVFIndex or HNSWIndex: the index
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError("unknown index %s, expected one of %s" % (index_type, INDEX_TYPES))
+    index_fn = '%s.%s' % (mat_fn, index_type)
+    fresh = os.path.exists(index_fn) and os.path.getmtime(index_fn) >= os.path.getmtime(mat_fn)
+
+    if index_type == 'ivf':
+        if fresh and not rebuild:
+            return IVFIndex.load(index_fn, nprobe=nprobe)
+        index = IVFIndex.build(mat, nlist=nlist, nprobe=nprobe)
+    else:
+        if fresh and not rebuild:
+            return HNSWIndex.load(index_fn)
+        index = HNSWIndex.build(mat)
+
+    tmp_fn = '%s.%d.tmp' % (index_fn, os.getpid())
+    index.save(tmp_fn)
+    os.replace(tmp_fn, index_fn)
+    return index
+
+
+def exact_topk(mata, queries, k, batch_size=65536):
+    """The exact top-k rows of mata for each query, merged across the blocks of mata"""
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    for start in tqdm(range(0, len(mata), batch_size)):
+        block = np.asarray(mata[start:start+batch_size], dtype=np.float32)
+        sims = queries @ block.T
+        best_scores, best_ids = topk_merge(best_scores, best_ids, sims,
+                                           np.broadcast_to(np.arange(start, start + len(block)),
+                                                           sims.shape), k)
+    return best_ids
+
+
+def _sample_queries(matb, sample, seed):
+    rng = np.random.RandomState(seed)
+    qs = np.sort(rng.choice(len(matb), min(sample, len(matb)), replace=False))
+    return np.asarray(matb[qs], dtype=np.float32)
+
+
+def _recall(index, mata, queries, exact, k):
+    approx_a, approx_q, _ = index.search(mata, queries, k=k)
+    approx = set(zip(approx_q.tolist(), approx_a.tolist()))
+    hits = sum((q, a) in approx for q in range(len(queries)) for a in exact[q].tolist())
+    return hits / float(len(queries) * k)
+
+
+def recall_at_k(mata, matb, index, k, sample=1000, seed=0):
+    """The recall@k of an index against the exact top-k on a sample of queries
+
+    Args:
+        mata (np.ndarray or EmbeddingMatrix): the indexed matrix
+        matb (np.ndarray or EmbeddingMatrix): the queries
+        index (IVFIndex or HNSWIndex): the index over mata
+        k (int): the number of neighbours
+        sample (int, optional): the number of sampled queries
+        seed (int, optional): the random seed
+
+    Returns:
+        float: the fraction of the exact top-k found by the index
+    """
+    queries = _sample_queries(matb, sample, seed)
+    k = min(k, len(mata))
+    return _recall(index, mata, queries, exact_topk(mata, queries, k), k)
+
+
+def tune_nprobe(mata, matb, index, k, target_recall=0.95, sample=1000, seed=0):
+    """Double the nprobe of an IVF index until it reaches a target recall@k
+
+    The recall is measured against the exact top-k on a sample of queries,
+    which is computed only once.
+
+    Args:
+        mata (np.ndarray or EmbeddingMatrix): the indexed matrix
+        matb (np.ndarray or EmbeddingMatrix): the queries
+        index (IVFIndex): the index over mata (its nprobe is updated)
+        k (int): the number of neighbours
+        target_recall (float, optional): the recall@k to reach
+        sample (int, optional): the number of sampled queries
+        seed (int, optional): the random seed
+
+    Returns:
+        float: the recall@k with the selected nprobe
+    """
+    queries = _sample_queries(matb, sample, seed)
+    k = min(k, len(mata))
+    exact = exact_topk(mata, queries, k)
+    recall = _recall(index, mata, queries, exact, k)
+    while recall < target_recall and index.nprobe < len(index.centroids):
+        index.nprobe = min(2 * index.nprobe, len(index.centroids))
+        recall = _recall(index, mata, queries, exact, k)
+    return recall
@@ -1,90 +1,160 @@
 import os
 import sys
 import jsonlines
-import pickle
 import numpy as np
 import argparse
 
 from tqdm import tqdm
 
+from ann import INDEX_TYPES, load_or_build_index, recall_at_k, topk_merge, tune_nprobe
+from embeddings import DTYPES, EmbeddingMatrix, append_rows, create_matrix, read_header
+
 sys.path.append("sentence-transformers")
 
 from sentence_transformers import SentenceTransformer
 
-def encode_all(path, input_fn, model, overwrite=False):
+def read_entries(input_fn):
+    """Read the serialized entries of a file, one per line"""
+    with open(input_fn, encoding='utf-8') as fin:
+        return [line.rstrip('\n') for line in fin]
+
+
+def encode_all(path, input_fn, model, overwrite=False, dtype='float16', chunk_size=65536):
     """Encode a collection of entries and output to a file
 
+    The normalized vectors are stored in input_fn + '.mat' as a contiguous
+    float16 (or int8) matrix and returned memory-mapped. When entries were
+    appended to input_fn since the last run, only the new ones are encoded;
+    use overwrite if existing entries changed.
+
     Args:
         path (str): the input path
         input_fn (str): the file of the serialzied entries
         model (SentenceTransformer): the transformer model
         overwrite (boolean, optional): whether to overwrite out_fn
+        dtype (str, optional): the storage type: float32, float16 or int8
+        chunk_size (int, optional): the number of entries encoded per append
 
     Returns:
         List of str: the serialized entries
-        List of np.ndarray: the encoded vectors
+        EmbeddingMatrix: the encoded vectors
     """
     input_fn = os.path.join(path, input_fn)
     output_fn = input_fn + '.mat'
+    lines = read_entries(input_fn)
 
-    # read from input_fn
-    lines = open(input_fn).read().split('\n')
+    # legacy pickles, another storage type or a shorter input are re-encoded
+    n_rows = None
+    if os.path.exists(output_fn) and not overwrite:
+        header = read_header(output_fn)
+        if header is not None and header[0] == dtype and header[2] <= len(lines):
+            n_rows = header[2]
+    if n_rows is None:
+        create_matrix(output_fn, model.get_sentence_embedding_dimension(), dtype)
+        n_rows = 0
 
-    # encode and dump
-    if not os.path.exists(output_fn) or overwrite:
-        vectors = model.encode(lines)
-        vectors = [v / np.linalg.norm(v) for v in vectors]
-        pickle.dump(vectors, open(output_fn, 'wb'))
-    else:
-        vectors = pickle.load(open(output_fn, 'rb'))
-    return lines, vectors
+    # encode and append
+    for start in range(n_rows, len(lines), chunk_size):
+        append_rows(output_fn, model.encode(lines[start:start+chunk_size]))
+    return lines, EmbeddingMatrix(output_fn)
 
 
 def blocked_matmul(mata, matb,
                    threshold=None,
                    k=None,
-                   batch_size=512):
+                   batch_size=512,
+                   index=None,
+                   chunk_size=32768):
     """Find the most similar pairs of vectors from two matrices (top-k or threshold)
 
+    The similarities are computed in float32, one chunk of mata times one
+    block of matb at a time, so memory-mapped (float16 or int8) matrices are
+    only converted a slice at a time. With k, each row of matb keeps its
+    top-k rows of mata (argpartition per chunk, merged across chunks); with
+    threshold, all pairs at or above it are kept; with both, the top-k pairs
+    at or above the threshold.
+
     Args:
-        mata (np.ndarray): the first matrix
-        matb (np.ndarray): the second matrix
+        mata (np.ndarray or EmbeddingMatrix): the first matrix
+        matb (np.ndarray or EmbeddingMatrix): the second matrix
         threshold (float, optional): if set, return all pairs of cosine
             similarity above the threshold
         k (int, optional): if set, return for each row in matb the top-k
             most similar vectors in mata
         batch_size (int, optional): the batch size of each block
+        index (IVFIndex or HNSWIndex, optional): if set, an ANN index over
+            mata: each block of matb is searched in the index instead of
+            being multiplied with the whole mata
+        chunk_size (int, optional): the rows of mata multiplied at a time
 
     Returns:
-        list of tuples: the pairs of similar vectors' indices and the similarity
+        np.ndarray: the indices of the pairs in mata
+        np.ndarray: the indices of the pairs in matb
+        np.ndarray: the float32 similarities, in decreasing order for each row of matb
     """
-    mata = np.array(mata)
-    matb = np.array(matb)
-    results = []
-    for start in tqdm(range(0, len(matb), batch_size)):
-        block = matb[start:start+batch_size]
-        sim_mat = np.matmul(mata, block.transpose())
+    if k is None and threshold is None:
+        raise ValueError("either k or threshold must be set")
+    blocks = []
+
+    if index is not None:
+        for start in tqdm(range(0, len(matb), batch_size)):
+            block = np.asarray(matb[start:start+batch_size], dtype=np.float32)
+            idx_a, idx_b, scores = index.search(mata, block, k=k, threshold=threshold)
+            if threshold is not None:
+                keep = scores >= threshold
+                idx_a, idx_b, scores = idx_a[keep], idx_b[keep], scores[keep]
+            blocks.append((idx_a, idx_b + start, scores))
+    else:
         if k is not None:
-            indices = np.argpartition(-sim_mat, k, axis=0)
-            for row in indices[:k]:
-                for idx_b, idx_a in enumerate(row):
-                    idx_b += start
-                    results.append((idx_a, idx_b, sim_mat[idx_a][idx_b-start]))
+            k = min(k, len(mata))
+            top_s = np.full((len(matb), k), -np.inf, dtype=np.float32)
+            top_a = np.full((len(matb), k), -1, dtype=np.int64)
+
+        n_blocks = -(-len(matb) // batch_size)
+        pbar = tqdm(total=-(-len(mata) // chunk_size) * n_blocks)
+        for a_start in range(0, len(mata), chunk_size):
+            chunk = np.asarray(mata[a_start:a_start+chunk_size], dtype=np.float32)
+            for start in range(0, len(matb), batch_size):
+                block = np.asarray(matb[start:start+batch_size], dtype=np.float32)
+                sim_mat = block @ chunk.T  # (block rows, chunk rows)
+                if k is not None:
+                    if sim_mat.shape[1] > k:
+                        cand = np.argpartition(-sim_mat, k - 1, axis=1)[:, :k]
+                        sim_mat = np.take_along_axis(sim_mat, cand, axis=1)
+                    else:
+                        cand = np.broadcast_to(np.arange(sim_mat.shape[1]), sim_mat.shape)
+                    rows = slice(start, start + len(block))
+                    top_s[rows], top_a[rows] = topk_merge(top_s[rows], top_a[rows],
+                                                          sim_mat, cand + a_start, k)
+                else:
+                    idx_b, idx_a = np.nonzero(sim_mat >= threshold)
+                    blocks.append((idx_a + a_start, idx_b + start, sim_mat[idx_b, idx_a]))
+                pbar.update(1)
+        pbar.close()
 
-        if threshold is not None:
-            indices = np.argwhere(sim_mat >= threshold)
-            total += len(indices)
-            for idx_a, idx_b in indices:
-                idx_b += start
-                results.append((idx_a, idx_b, sim_mat[idx_a][idx_b-start]))
-    return results
+        if k is not None:
+            # only the k kept scores of each row are sorted
+            order = np.argsort(-top_s, axis=1)
+            out_a = np.take_along_axis(top_a, order, axis=1).ravel()
+            out_s = np.take_along_axis(top_s, order, axis=1).ravel()
+            out_b = np.repeat(np.arange(len(matb), dtype=np.int64), k)
+            if threshold is not None:
+                keep = out_s >= threshold
+                return out_a[keep], out_b[keep], out_s[keep]
+            return out_a, out_b, out_s
+
+    if not blocks:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    idx_a, idx_b, scores = (np.concatenate(x) for x in zip(*blocks))
+    order = np.lexsort((-scores, idx_b))
+    return idx_a[order], idx_b[order], scores[order]
 
 
 def dump_pairs(out_fn, entries_a, entries_b, pairs):
-    """Dump the pairs to a jsonl file
+    """Dump the pairs (idx_a, idx_b, score arrays of blocked_matmul) to a jsonl file
     """
     with jsonlines.open(out_fn, mode='w') as writer:
-        for idx_a, idx_b, score in pairs:
+        for idx_a, idx_b, score in zip(*pairs):
             writer.write([entries_a[idx_a], entries_b[idx_b], str(score)])
 
 if __name__ == "__main__":
@@ -97,6 +167,12 @@ if __name__ == "__main__":
     parser.add_argument("--batch_size", type=int, default=512)
     parser.add_argument("--k", type=int, default=10)
     parser.add_argument("--threshold", type=float, default=None) # 0.6
+    parser.add_argument("--index", type=str, default=None, choices=INDEX_TYPES)
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, default=None)
+    parser.add_argument("--target_recall", type=float, default=None)
+    parser.add_argument("--recall_sample", type=int, default=0)
+    parser.add_argument("--dtype", type=str, default='float16', choices=list(DTYPES))
     hp = parser.parse_args()
 
     # load the model
@@ -106,15 +182,30 @@ if __name__ == "__main__":
     mata = matb = None
     entries_a = entries_b = None
     if hp.left_fn is not None:
-        entries_a, mata = encode_all(hp.input_path, hp.left_fn, model)
+        entries_a, mata = encode_all(hp.input_path, hp.left_fn, model, dtype=hp.dtype)
     if hp.right_fn is not None:
-        entries_b, matb = encode_all(hp.input_path, hp.right_fn, model)
+        entries_b, matb = encode_all(hp.input_path, hp.right_fn, model, dtype=hp.dtype)
+
+    if mata is not None and matb is not None:
+        index = None
+        if hp.index is not None:
+            # built once over the left table, persisted next to its .mat file
+            mat_fn = os.path.join(hp.input_path, hp.left_fn) + '.mat'
+            index = load_or_build_index(mat_fn, mata, hp.index,
+                                        nlist=hp.nlist, nprobe=hp.nprobe)
+            if hp.target_recall is not None and hp.index == 'ivf' and hp.k is not None:
+                recall = tune_nprobe(mata, matb, index, hp.k, hp.target_recall,
+                                     sample=hp.recall_sample or 1000)
+                print("nprobe = %d, recall@%d = %.4f" % (index.nprobe, hp.k, recall))
+            elif hp.recall_sample > 0 and hp.k is not None:
+                print("recall@%d = %.4f" % (hp.k, recall_at_k(mata, matb, index,
+                                                             hp.k, sample=hp.recall_sample)))
 
-    if mata and matb:
         pairs = blocked_matmul(mata, matb,
                    threshold=hp.threshold,
                    k=hp.k,
-                   batch_size=hp.batch_size)
+                   batch_size=hp.batch_size,
+                   index=index)
         dump_pairs(os.path.join(hp.input_path, hp.output_fn),
                    entries_a,
                    entries_b,
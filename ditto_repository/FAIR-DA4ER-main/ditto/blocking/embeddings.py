@@ -0,0 +1,135 @@
+import struct
+import numpy as np
+
+
+# header: magic, version, dtype code, dim, number of rows (padded to 64 bytes)
+MAGIC = b'DITTOEMB'
+VERSION = 1
+HEADER_FORMAT = '<8sIIIQ'
+HEADER_SIZE = 64
+
+DTYPES = {'float32': (0, np.float32), 'float16': (1, np.float16), 'int8': (2, np.int8)}
+CODES = {code: (name, dtype) for name, (code, dtype) in DTYPES.items()}
+
+# int8 rows store round(127 * x) of the unit-norm vectors
+INT8_SCALE = 127.0
+
+
+def normalize(vectors):
+    """L2-normalize the rows of a matrix (zero rows stay zero)."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def read_header(path):
+    """Read the header of an embedding file
+
+    Args:
+        path (str): the file
+
+    Returns:
+        (str, int, int): the dtype name, the dimension and the number of rows,
+            or None if the file is not in this format (e.g. a legacy pickle)
+    """
+    with open(path, 'rb') as fin:
+        header = fin.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or header[:len(MAGIC)] != MAGIC:
+        return None
+    _, version, code, dim, n_rows = struct.unpack_from(HEADER_FORMAT, header)
+    if version != VERSION or code not in CODES:
+        return None
+    return CODES[code][0], dim, n_rows
+
+
+def _write_header(fout, dtype, dim, n_rows):
+    header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, DTYPES[dtype][0], dim, n_rows)
+    fout.seek(0)
+    fout.write(header.ljust(HEADER_SIZE, b'\0'))
+
+
+def create_matrix(path, dim, dtype='float16'):
+    """Create an empty embedding file
+
+    Args:
+        path (str): the file
+        dim (int): the dimension of the vectors
+        dtype (str, optional): the storage type: float32, float16 or int8
+    """
+    if dtype not in DTYPES:
+        raise ValueError("unknown dtype %s, expected one of %s" % (dtype, list(DTYPES)))
+    with open(path, 'wb') as fout:
+        _write_header(fout, dtype, dim, 0)
+
+
+def append_rows(path, vectors):
+    """Normalize, quantize and append vectors to an embedding file
+
+    The rows are written before the row count of the header is updated, so
+    an interrupted append leaves the file readable with its previous rows.
+
+    Args:
+        path (str): the file (created by create_matrix)
+        vectors (np.ndarray): the (n, dim) vectors
+
+    Returns:
+        int: the number of rows in the file
+    """
+    dtype, dim, n_rows = read_header(path)
+    vectors = normalize(vectors)
+    if vectors.ndim != 2 or vectors.shape[1] != dim:
+        raise ValueError("expected vectors of dimension %d" % dim)
+
+    if dtype == 'int8':
+        rows = np.clip(np.rint(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+    else:
+        rows = vectors.astype(DTYPES[dtype][1])
+
+    with open(path, 'r+b') as fout:
+        fout.seek(HEADER_SIZE + n_rows * dim * rows.itemsize)
+        fout.write(rows.tobytes())
+        fout.truncate()
+        n_rows += len(rows)
+        _write_header(fout, dtype, dim, n_rows)
+    return n_rows
+
+
+class EmbeddingMatrix:
+    """A read-only, memory-mapped embedding file
+
+    Indexing returns float32 rows (dequantized for int8), so slices of the
+    matrix can be used directly in a matmul without loading the whole file.
+
+    Args:
+        path (str): the file
+    """
+
+    def __init__(self, path):
+        header = read_header(path)
+        if header is None:
+            raise ValueError("%s is not an embedding file" % path)
+        self.path = path
+        self.storage, dim, n_rows = header
+        if n_rows > 0:
+            self.data = np.memmap(path, dtype=DTYPES[self.storage][1], mode='r',
+                                  offset=HEADER_SIZE, shape=(n_rows, dim))
+        else:
+            self.data = np.zeros((0, dim), dtype=DTYPES[self.storage][1])
+        self.scale = 1.0 / INT8_SCALE if self.storage == 'int8' else 1.0
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __getitem__(self, idx):
+        rows = np.asarray(self.data[idx], dtype=np.float32)
+        if self.scale != 1.0:
+            rows *= self.scale
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        rows = self[:]
+        return rows if dtype is None else rows.astype(dtype)
@@ -0,0 +1,71 @@
+import os
+import argparse
+import json
+import time
+import numpy as np
+
+from matcher import load_model, set_seed
+from ditto_light.dataset import get_tokenizer
+from ditto_light.distill import read_pairs, label_pool, make_student, distill, compare, save_student
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--task", type=str, default="auto_task")
+    parser.add_argument("--lm", type=str, default='distilbert')
+    parser.add_argument("--checkpoint_path", type=str, default='checkpoints/')
+    parser.add_argument("--pool", type=str, nargs='*', default=[])
+    parser.add_argument("--pool_size", type=int, default=200000)
+    parser.add_argument("--n_layers", type=int, default=2)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--lr", type=float, default=5e-5)
+    parser.add_argument("--n_epochs", type=int, default=3)
+    parser.add_argument("--temperature", type=float, default=2.0)
+    parser.add_argument("--alpha", type=float, default=0.5)
+    parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--token_budget", type=int, default=16384)
+    parser.add_argument("--output_dir", type=str, default='students/')
+    parser.add_argument("--run_id", type=int, default=0)
+    hp = parser.parse_args()
+
+    set_seed(hp.run_id)
+
+    # the trained Ditto model is the teacher
+    config, teacher = load_model(hp.task, hp.checkpoint_path, hp.lm, use_gpu=False)
+    teacher.eval()
+
+    # transfer set: the labeled training pairs + the unlabeled candidate pool
+    lefts, rights, labels = read_pairs(config['trainset'])
+    for path in hp.pool:
+        pool_lefts, pool_rights, _ = read_pairs(path, size=hp.pool_size)
+        lefts += pool_lefts
+        rights += pool_rights
+        labels += [-1] * len(pool_lefts)
+    print(f"transfer set: {len(lefts)} pairs ({len(lefts) - labels.count(-1)} labeled)")
+
+    start_time = time.time()
+    token_ids, offsets, teacher_logits = label_pool(teacher, lefts, rights, hp.lm,
+                                                    max_len=hp.max_len,
+                                                    token_budget=hp.token_budget)
+    print(f"⏱️ Tempo Etichettatura Teacher: {time.time() - start_time:.4f}s")
+
+    # distill into a smaller transformer
+    student = make_student(teacher, hp.n_layers)
+    start_time = time.time()
+    distill(student, token_ids, offsets, teacher_logits, hp,
+            labels=np.asarray(labels, dtype=np.int64))
+    print(f"⏱️ Tempo Distillazione: {time.time() - start_time:.4f}s")
+
+    student_lm = save_student(student, get_tokenizer(hp.lm), hp.output_dir, hp.task)
+    print(f"student saved: --lm {student_lm} --checkpoint_path {hp.output_dir}")
+
+    # teacher vs student on the test set
+    reports = compare(teacher, student, config['validset'], config['testset'],
+                      hp.lm, student_lm,
+                      max_len=hp.max_len,
+                      token_budget=hp.token_budget)
+    for report in reports:
+        print("%-8s %10.1f pairs/s  f1=%.4f  threshold=%.4f  agreement=%.4f" % (
+            report['model'], report['pairs/s'], report['f1'],
+            report['threshold'], report['agreement']))
+    with open(os.path.join(hp.output_dir, hp.task, 'report.json'), 'w') as fout:
+        json.dump(reports, fout, indent=2)
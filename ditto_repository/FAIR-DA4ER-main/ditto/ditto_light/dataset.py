@@ -1,3 +1,7 @@
+import os
+import random
+import hashlib
+import numpy as np
 import torch
 
 from torch.utils import data
@@ -16,6 +20,160 @@ def get_tokenizer(lm):
         return AutoTokenizer.from_pretrained(lm)
 
 
+def batch_encode(tokenizer, lefts, rights, max_len=256, chunk_size=8192):
+    """Tokenize entity pairs with batched tokenizer calls.
+
+    Args:
+        tokenizer (Tokenizer): a (fast) huggingface tokenizer
+        lefts (list of str): the left entries
+        rights (list of str): the right entries
+        max_len (int, optional): the max sequence length
+        chunk_size (int, optional): the number of pairs per tokenizer call
+
+    Returns:
+        np.ndarray: the token ID's of all pairs in a flat int32 array
+        np.ndarray: the offsets (n_pairs + 1,) of each pair in the flat array
+    """
+    chunks = []
+    lengths = np.zeros(len(lefts), dtype=np.int64)
+    for start in range(0, len(lefts), chunk_size):
+        enc = tokenizer(lefts[start:start+chunk_size],
+                        rights[start:start+chunk_size],
+                        max_length=max_len,
+                        truncation=True,
+                        padding=True,
+                        return_tensors='np')
+        # drop the padding of the chunk: row-major masking keeps each pair contiguous
+        mask = enc['attention_mask'].astype(bool)
+        lengths[start:start+len(mask)] = mask.sum(axis=1)
+        chunks.append(enc['input_ids'][mask].astype(np.int32))
+
+    offsets = np.zeros(len(lefts) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    token_ids = np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int32)
+    return token_ids, offsets
+
+
+def file_hash(path, block_size=1 << 20):
+    """Return the sha1 hex digest of a file's content."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def cached_batch_encode(tokenizer, path, lefts, rights, lm, max_len, cache_dir):
+    """Tokenize the pairs of a file once and memory-map the result afterwards.
+
+    The cache entry is keyed by the file content hash, the LM name and
+    max_len, and is stored as two .npy files (token ID's and offsets) in
+    cache_dir. Entries are written atomically, so concurrent runs on the
+    same file are safe and share the page cache when reading.
+
+    Args:
+        tokenizer (Tokenizer): a (fast) huggingface tokenizer
+        path (str): the dataset file the pairs were read from
+        lefts (list of str): the left entries of all the lines in path
+        rights (list of str): the right entries of all the lines in path
+        lm (str): the language model name
+        max_len (int): the max sequence length
+        cache_dir (str): the cache directory
+
+    Returns:
+        np.ndarray: the (memory-mapped) flat int32 token ID's
+        np.ndarray: the (memory-mapped) offsets of each pair
+    """
+    key = hashlib.sha1(('%s|%s|%d' % (file_hash(path), lm, max_len)).encode()).hexdigest()
+    ids_fn = os.path.join(cache_dir, key + '.ids.npy')
+    offsets_fn = os.path.join(cache_dir, key + '.offsets.npy')
+
+    if not (os.path.exists(ids_fn) and os.path.exists(offsets_fn)):
+        token_ids, offsets = batch_encode(tokenizer, lefts, rights, max_len=max_len)
+        os.makedirs(cache_dir, exist_ok=True)
+        for fn, arr in [(ids_fn, token_ids), (offsets_fn, offsets)]:
+            tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+            with open(tmp_fn, 'wb') as fout:
+                np.save(fout, arr)
+            os.replace(tmp_fn, fn)
+
+    return np.load(ids_fn, mmap_mode='r'), np.load(offsets_fn, mmap_mode='r')
+
+
+def pad_sequences(seqs):
+    """Zero-pad a list of token ID sequences into a (batch_size, max_len) array.
+
+    Args:
+        seqs (list of np.ndarray or list of int): the sequences
+
+    Returns:
+        np.ndarray: the padded int64 array
+        np.ndarray: the int64 attention mask (1 for tokens, 0 for padding)
+    """
+    lengths = np.fromiter((len(x) for x in seqs), dtype=np.int64, count=len(seqs))
+    maxlen = lengths.max() if len(seqs) else 0
+    out = np.zeros((len(seqs), maxlen), dtype=np.int64)
+    if lengths.sum() > 0:
+        flat = np.concatenate([np.asarray(x, dtype=np.int64) for x in seqs])
+        rows = np.repeat(np.arange(len(seqs)), lengths)
+        cols = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        out[rows, cols] = flat
+    mask = (np.arange(maxlen)[None, :] < lengths[:, None]).astype(np.int64)
+    return out, mask
+
+
+class LengthGroupedSampler(data.Sampler):
+    """Batch sampler that groups sequences of similar length.
+
+    The indices are shuffled, split into mega-batches of ``mega_batch_mult``
+    batches, sorted by length inside each mega-batch and cut into batches;
+    the order of the batches is shuffled again. Batches stay random across
+    epochs but carry little padding.
+
+    Args:
+        lengths (np.ndarray): the token length of each item
+        batch_size (int): the batch size
+        mega_batch_mult (int, optional): the number of batches per mega-batch
+    """
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.mega_batch_size = batch_size * mega_batch_mult
+
+    def __iter__(self):
+        perm = np.random.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(perm), self.mega_batch_size):
+            mega = perm[start:start+self.mega_batch_size]
+            mega = mega[np.argsort(-self.lengths[mega], kind='stable')]
+            batches += [mega[i:i+self.batch_size].tolist()
+                        for i in range(0, len(mega), self.batch_size)]
+        for i in np.random.permutation(len(batches)):
+            yield batches[i]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def worker_init_fn(worker_id):
+    """Prepare a DataLoader worker process for a DittoDataset.
+
+    Each worker gets its own tokenizer (a forked copy of the parent's fast
+    tokenizer must not share its thread pool) and its own random seed, so
+    the workers do not apply the same augmentations.
+    """
+    info = data.get_worker_info()
+    seed = info.seed % (2 ** 32)
+    random.seed(seed)
+    np.random.seed(seed)
+
+    dataset = info.dataset
+    if isinstance(dataset, data.Subset):
+        dataset = dataset.dataset
+    dataset.tokenizer = get_tokenizer(dataset.lm)
+
+
 class DittoDataset(data.Dataset):
     """EM dataset"""
 
@@ -24,7 +182,10 @@ class DittoDataset(data.Dataset):
                  max_len=256,
                  size=None,
                  lm='roberta',
-                 da=None):
+                 da=None,
+                 pretokenize=True,
+                 cache_dir=None):
+        self.lm = lm
         self.tokenizer = get_tokenizer(lm)
         self.pairs = []
         self.labels = []
@@ -41,6 +202,7 @@ class DittoDataset(data.Dataset):
             self.pairs.append((s1, s2))
             self.labels.append(int(label))
 
+        all_pairs = self.pairs
         self.pairs = self.pairs[:size]
         self.labels = self.labels[:size]
         self.da = da
@@ -49,6 +211,21 @@ class DittoDataset(data.Dataset):
         else:
             self.augmenter = None
 
+        # tokenize all the pairs upfront into a flat int32 array + offsets
+        self.token_ids = self.offsets = None
+        if pretokenize and cache_dir is not None and not isinstance(path, list):
+            # the cache covers the whole file, size only limits the offsets
+            self.token_ids, offsets = cached_batch_encode(self.tokenizer, path,
+                                                          [p[0] for p in all_pairs],
+                                                          [p[1] for p in all_pairs],
+                                                          lm, self.max_len, cache_dir)
+            self.offsets = offsets[:len(self.pairs) + 1]
+        elif pretokenize:
+            self.token_ids, self.offsets = batch_encode(self.tokenizer,
+                                                        [p[0] for p in self.pairs],
+                                                        [p[1] for p in self.pairs],
+                                                        max_len=self.max_len)
+
 
     def __len__(self):
         """Return the size of the dataset."""
@@ -69,10 +246,13 @@ class DittoDataset(data.Dataset):
         right = self.pairs[idx][1]
 
         # left + right
-        x = self.tokenizer.encode(text=left,
-                                  text_pair=right,
-                                  max_length=self.max_len,
-                                  truncation=True)
+        if self.token_ids is not None:
+            x = self.token_ids[self.offsets[idx]:self.offsets[idx+1]]
+        else:
+            x = self.tokenizer.encode(text=left,
+                                      text_pair=right,
+                                      max_length=self.max_len,
+                                      truncation=True)
 
         # augment if da is set
         if self.da is not None:
@@ -92,6 +272,16 @@ class DittoDataset(data.Dataset):
         else:
             return x, self.labels[idx]
 
+    def lengths(self):
+        """Return the token length of every item (without augmentation)."""
+        if self.offsets is not None:
+            return np.diff(self.offsets)
+        return np.array([len(self.tokenizer.encode(text=left,
+                                                   text_pair=right,
+                                                   max_length=self.max_len,
+                                                   truncation=True))
+                         for left, right in self.pairs])
+
     @staticmethod
     def pad(batch):
         """Merge a list of dataset items into a train/test batch
@@ -100,23 +290,25 @@ class DittoDataset(data.Dataset):
 
         Returns:
             LongTensor: x1 of shape (batch_size, seq_len)
-            LongTensor: x2 of shape (batch_size, seq_len).
+            LongTensor: x2 of shape (batch_size, seq_len) (if da is set).
                         Elements of x1 and x2 are padded to the same length
+            LongTensor: the attention mask of x1 (and of x2 if da is set)
             LongTensor: a batch of labels, (batch_size,)
         """
         if len(batch[0]) == 3:
             x1, x2, y = zip(*batch)
 
-            maxlen = max([len(x) for x in x1+x2])
-            x1 = [xi + [0]*(maxlen - len(xi)) for xi in x1]
-            x2 = [xi + [0]*(maxlen - len(xi)) for xi in x2]
-            return torch.LongTensor(x1), \
-                   torch.LongTensor(x2), \
+            # x1 and x2 are padded to the same length
+            x12, mask12 = pad_sequences(x1 + x2)
+            x12, mask12 = torch.from_numpy(x12), torch.from_numpy(mask12)
+            return x12[:len(x1)], \
+                   x12[len(x1):], \
+                   mask12[:len(x1)], \
+                   mask12[len(x1):], \
                    torch.LongTensor(y)
         else:
             x12, y = zip(*batch)
-            maxlen = max([len(x) for x in x12])
-            x12 = [xi + [0]*(maxlen - len(xi)) for xi in x12]
-            return torch.LongTensor(x12), \
+            x12, mask = pad_sequences(x12)
+            return torch.from_numpy(x12), \
+                   torch.from_numpy(mask), \
                    torch.LongTensor(y)
-
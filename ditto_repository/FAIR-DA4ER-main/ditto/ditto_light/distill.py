@@ -0,0 +1,231 @@
+import os
+import re
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from transformers import AutoModel
+from transformers.optimization import get_linear_schedule_with_warmup
+
+from .dataset import batch_encode, pad_sequences, LengthGroupedSampler
+from .ditto import threshold_f1
+from .inference import InferenceEngine
+
+
+def read_pairs(path, size=None):
+    """Read the (left, right) entries and the labels of a Ditto .txt file.
+
+    Candidate files written by prepare_ditto_candidates.py carry a dummy
+    label and a pair id; only the first two columns are used for them.
+
+    Args:
+        path (str): the .txt file
+        size (int, optional): read at most this many pairs
+
+    Returns:
+        list of str: the left entries
+        list of str: the right entries
+        list of int: the labels (3rd column)
+    """
+    lefts, rights, labels = [], [], []
+    with open(path) as fin:
+        for line in fin:
+            if size is not None and len(lefts) >= size:
+                break
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 3:
+                continue
+            lefts.append(fields[0])
+            rights.append(fields[1])
+            labels.append(int(fields[2]))
+    return lefts, rights, labels
+
+
+def label_pool(teacher, lefts, rights, lm, max_len=256, token_budget=16384):
+    """Tokenize the transfer pairs once and run the teacher over them.
+
+    Args:
+        teacher (DittoModel): the trained teacher
+        lefts (list of str): the left entries
+        rights (list of str): the right entries
+        lm (str): the language model of the teacher
+        max_len (int, optional): the max sequence length
+        token_budget (int, optional): max number of padded tokens per forward pass
+
+    Returns:
+        np.ndarray: the flat int32 token ID's of the pairs
+        np.ndarray: the offsets of each pair in the flat array
+        np.ndarray: the teacher logits of shape (n_pairs, 2)
+    """
+    engine = InferenceEngine(teacher, lm=lm, max_len=max_len, token_budget=token_budget)
+    token_ids, offsets = batch_encode(engine.tokenizer, lefts, rights, max_len=max_len)
+    return token_ids, offsets, engine.forward(token_ids, offsets)
+
+
+def make_student(teacher, n_layers):
+    """Build a student with the first, last and evenly spaced layers of the teacher.
+
+    The student keeps the teacher's embeddings, tokenizer and head, so it
+    starts close to the teacher and is fine-tuned by distillation.
+
+    Args:
+        teacher (DittoModel): the trained teacher
+        n_layers (int): the number of transformer layers of the student
+
+    Returns:
+        DittoModel: the student
+    """
+    config = copy.deepcopy(teacher.bert.config)
+    attr = 'n_layers' if hasattr(config, 'n_layers') else 'num_hidden_layers'
+    teacher_layers = getattr(config, attr)
+    if not 0 < n_layers <= teacher_layers:
+        raise ValueError("the student needs 1 to %d layers" % teacher_layers)
+    setattr(config, attr, n_layers)
+
+    # student layer i <- teacher layer kept[i]
+    kept = np.linspace(0, teacher_layers - 1, n_layers).round().astype(int).tolist()
+    state = {}
+    for name, value in teacher.bert.state_dict().items():
+        match = re.search(r'\.layer\.(\d+)\.', name)
+        if match is None:
+            state[name] = value
+        elif int(match.group(1)) in kept:
+            new_id = kept.index(int(match.group(1)))
+            state[name.replace(match.group(0), '.layer.%d.' % new_id, 1)] = value
+
+    student = copy.deepcopy(teacher)
+    student.bert = AutoModel.from_config(config)
+    student.bert.load_state_dict(state)
+    return student
+
+
+def distill(student, token_ids, offsets, teacher_logits, hp, labels=None):
+    """Train the student on the soft predictions of the teacher.
+
+    The loss is the KL divergence between the temperature-softened teacher
+    and student distributions; pairs with a gold label (labels >= 0) add a
+    cross-entropy term weighted by hp.alpha.
+
+    Args:
+        student (DittoModel): the student
+        token_ids (np.ndarray): the flat token ID's of the transfer pairs
+        offsets (np.ndarray): the offsets of each pair in token_ids
+        teacher_logits (np.ndarray): the teacher logits of shape (n_pairs, 2)
+        hp (Namespace): batch_size, lr, n_epochs, temperature, alpha
+        labels (np.ndarray, optional): the gold labels, -1 for unlabeled pairs
+
+    Returns:
+        None
+    """
+    n = len(offsets) - 1
+    labels = np.full(n, -1, dtype=np.int64) if labels is None else labels
+    targets = torch.from_numpy(np.asarray(teacher_logits, dtype=np.float32))
+    labels = torch.from_numpy(labels)
+    sampler = LengthGroupedSampler(np.diff(offsets), hp.batch_size)
+
+    optimizer = optim.Adam(student.parameters(), lr=hp.lr)
+    scheduler = get_linear_schedule_with_warmup(optimizer,
+                                                num_warmup_steps=0,
+                                                num_training_steps=len(sampler) * hp.n_epochs)
+    T = hp.temperature
+    student.train()
+    for epoch in range(1, hp.n_epochs+1):
+        for i, batch in enumerate(sampler):
+            batch = np.asarray(batch)
+            x, mask = pad_sequences([token_ids[offsets[j]:offsets[j+1]] for j in batch])
+            logits = student(torch.from_numpy(x), mask1=torch.from_numpy(mask))
+            soft = targets[batch].to(logits.device)
+            loss = F.kl_div(F.log_softmax(logits / T, dim=1),
+                            F.softmax(soft / T, dim=1),
+                            reduction='batchmean') * T * T
+
+            gold = labels[batch].to(logits.device)
+            if hp.alpha > 0 and (gold >= 0).any():
+                loss = loss + hp.alpha * F.cross_entropy(logits, gold, ignore_index=-1)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            if i % 100 == 0:
+                print(f"epoch {epoch}, step: {i}, loss: {loss.item()}")
+    student.eval()
+
+
+def compare(teacher, student, validset, testset, lm, student_lm,
+            max_len=256, token_budget=16384):
+    """Report the throughput and the F1 of the teacher and the student.
+
+    Each model uses the threshold that maximizes its F1 on the validation set.
+
+    Args:
+        teacher (DittoModel): the teacher
+        student (DittoModel): the student
+        validset (str): the validation .txt file
+        testset (str): the test .txt file
+        lm (str): the language model of the teacher
+        student_lm (str): the language model (directory) of the student
+        max_len (int, optional): the max sequence length
+        token_budget (int, optional): max number of padded tokens per forward pass
+
+    Returns:
+        list of dict: one report per model
+    """
+    valid_pairs = [line.rstrip('\n') for line in open(validset) if line.strip()]
+    test_pairs = [line.rstrip('\n') for line in open(testset) if line.strip()]
+    valid_y = [int(p.split('\t')[2]) for p in valid_pairs]
+    test_y = [int(p.split('\t')[2]) for p in test_pairs]
+
+    reports = []
+    teacher_pred = None
+    for name, model, model_lm in [('teacher', teacher, lm), ('student', student, student_lm)]:
+        engine = InferenceEngine(model, lm=model_lm, max_len=max_len, token_budget=token_budget)
+        _, th = threshold_f1(_probs(engine, valid_pairs), valid_y)
+
+        start = time.time()
+        probs = _probs(engine, test_pairs)
+        run_time = time.time() - start
+
+        pred = probs > th
+        if teacher_pred is None:
+            teacher_pred = pred
+        reports.append({'model': name,
+                        'pairs/s': len(test_pairs) / run_time,
+                        'f1': threshold_f1(probs, test_y, threshold=th),
+                        'threshold': th,
+                        'agreement': float((pred == teacher_pred).mean())})
+    return reports
+
+
+def _probs(engine, sentence_pairs):
+    """The match probabilities of serialized pairs."""
+    return torch.from_numpy(engine.predict_logits(sentence_pairs)).softmax(dim=1)[:, 1].numpy()
+
+
+def save_student(student, tokenizer, output_dir, task):
+    """Save the student so that matcher.py loads it with --lm and --checkpoint_path.
+
+    The encoder and the tokenizer go to <output_dir>/lm, the DittoModel
+    checkpoint to <output_dir>/<task>/model.pt.
+
+    Args:
+        student (DittoModel): the student
+        tokenizer (Tokenizer): the tokenizer of the teacher
+        output_dir (str): the output directory
+        task (str): the task name
+
+    Returns:
+        str: the path of the student LM (the --lm of matcher.py)
+    """
+    lm_dir = os.path.join(output_dir, 'lm')
+    student.bert.save_pretrained(lm_dir)
+    tokenizer.save_pretrained(lm_dir)
+
+    ckpt_dir = os.path.join(output_dir, task)
+    os.makedirs(ckpt_dir, exist_ok=True)
+    torch.save({'model': student.state_dict(), 'head': student.head},
+               os.path.join(ckpt_dir, 'model.pt'))
+    return lm_dir
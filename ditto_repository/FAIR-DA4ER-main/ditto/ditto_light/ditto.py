@@ -5,11 +5,11 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import random
+import contextlib
 import numpy as np
-import sklearn.metrics as metrics
 import argparse
 
-from .dataset import DittoDataset
+from .dataset import LengthGroupedSampler, worker_init_fn
 from torch.utils import data
 from transformers import AutoModel
 from transformers.optimization import get_linear_schedule_with_warmup
@@ -20,10 +20,32 @@ from torch import autocast, GradScaler
 lm_mp = {'roberta': 'roberta-base',
          'distilbert': 'distilbert-base-uncased'}
 
+HEADS = ['linear', 'mlp']
+
+def build_head(hidden_size, head='linear'):
+    """Build the classification layer on top of the [CLS] embedding
+
+    Args:
+        hidden_size (int): the embedding size of the LM
+        head (str, optional): one of HEADS
+
+    Returns:
+        nn.Module: the classifier returning 2 logits
+    """
+    if head == 'linear':
+        return torch.nn.Linear(hidden_size, 2)
+    if head == 'mlp':
+        return nn.Sequential(nn.Linear(hidden_size, hidden_size),
+                             nn.ReLU(),
+                             nn.Dropout(0.1),
+                             nn.Linear(hidden_size, 2))
+    raise ValueError("unknown head %s, expected one of %s" % (head, HEADS))
+
+
 class DittoModel(nn.Module):
     """A baseline model for EM."""
 
-    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8):
+    def __init__(self, device='cuda', lm='roberta', alpha_aug=0.8, head='linear'):
         super().__init__()
         if lm in lm_mp:
             self.bert = AutoModel.from_pretrained(lm_mp[lm])
@@ -33,26 +55,34 @@ class DittoModel(nn.Module):
         self.device = device
         self.alpha_aug = alpha_aug
 
-        # linear layer
+        # linear layer (or a small MLP, see HEADS)
         hidden_size = self.bert.config.hidden_size
-        self.fc = torch.nn.Linear(hidden_size, 2)
+        self.head = head
+        self.fc = build_head(hidden_size, head)
 
 
-    def forward(self, x1, x2=None):
+    def forward(self, x1, x2=None, mask1=None, mask2=None):
         """Encode the left, right, and the concatenation of left+right.
 
         Args:
             x1 (LongTensor): a batch of ID's
             x2 (LongTensor, optional): a batch of ID's (augmented)
+            mask1 (LongTensor, optional): the attention mask of x1
+            mask2 (LongTensor, optional): the attention mask of x2
 
         Returns:
             Tensor: binary prediction
         """
-        x1 = x1.to(self.device) # (batch_size, seq_len)
+        x1 = x1.to(self.device, non_blocking=True) # (batch_size, seq_len)
+        if mask1 is not None:
+            mask1 = mask1.to(self.device, non_blocking=True)
         if x2 is not None:
             # MixDA
-            x2 = x2.to(self.device) # (batch_size, seq_len)
-            enc = self.bert(torch.cat((x1, x2)))[0][:, 0, :]
+            x2 = x2.to(self.device, non_blocking=True) # (batch_size, seq_len)
+            mask = None
+            if mask1 is not None and mask2 is not None:
+                mask = torch.cat((mask1, mask2.to(self.device, non_blocking=True)))
+            enc = self.bert(torch.cat((x1, x2)), attention_mask=mask)[0][:, 0, :]
             batch_size = len(x1)
             enc1 = enc[:batch_size] # (batch_size, emb_size)
             enc2 = enc[batch_size:] # (batch_size, emb_size)
@@ -60,7 +90,7 @@ class DittoModel(nn.Module):
             aug_lam = np.random.beta(self.alpha_aug, self.alpha_aug)
             enc = enc1 * aug_lam + enc2 * (1.0 - aug_lam)
         else:
-            enc = self.bert(x1)[0][:, 0, :]
+            enc = self.bert(x1, attention_mask=mask1)[0][:, 0, :]
 
         return self.fc(enc) # .squeeze() # .sigmoid()
 
@@ -78,74 +108,129 @@ def evaluate(model, iterator, threshold=None):
         float (optional): if threshold is not provided, the threshold
             value that gives the optimal F1
     """
-    all_p = []
-    all_y = []
-    all_probs = []
+    n = len(iterator.dataset)
+    all_probs = torch.empty(n, dtype=torch.float32)
+    all_y = torch.empty(n, dtype=torch.long)
+    pos = 0
     with torch.no_grad():
         for batch in iterator:
-            x, y = batch
-            logits = model(x)
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_y += y.cpu().numpy().tolist()
+            x, mask, y = batch
+            logits = model(x, mask1=mask)
+            size = len(y)
+            all_probs[pos:pos + size] = logits.softmax(dim=1)[:, 1].float().cpu()
+            all_y[pos:pos + size] = y
+            pos += size
 
-    if threshold is not None:
-        pred = [1 if p > threshold else 0 for p in all_probs]
-        f1 = metrics.f1_score(all_y, pred)
-        return f1
-    else:
-        best_th = 0.5
-        f1 = 0.0 # metrics.f1_score(all_y, all_p)
+    return threshold_f1(all_probs[:pos].numpy(), all_y[:pos].numpy(), threshold=threshold)
 
-        for th in np.arange(0.0, 1.0, 0.05):
-            pred = [1 if p > th else 0 for p in all_probs]
-            new_f1 = metrics.f1_score(all_y, pred)
-            if new_f1 > f1:
-                f1 = new_f1
-                best_th = th
 
-        return f1, best_th
+def threshold_f1(all_probs, all_y, threshold=None):
+    """Compute the F1 score of match probabilities
 
+    Without a threshold, the probabilities are sorted once and the F1 of
+    every distinct threshold is computed from cumulative true-positive
+    counts, so the search is O(n log n) and the threshold is exact. The
+    returned threshold lies halfway between two distinct probabilities (or
+    below the smallest one), so predicting with p > threshold reproduces
+    the returned F1.
+
+    Args:
+        all_probs (array of float): the probabilities of the 1-class
+        all_y (array of int): the labels
+        threshold (float, optional): the threshold on the 0-class
 
-def train_step(train_iter, model, optimizer, scheduler, hp, scaler=None):
+    Returns:
+        float: the F1 score
+        float (optional): if threshold is not provided, the threshold
+            value that gives the optimal F1
+    """
+    all_probs = np.asarray(all_probs, dtype=np.float64)
+    all_y = np.asarray(all_y) == 1
+    num_pos = int(all_y.sum())
+
+    if threshold is not None:
+        pred = all_probs > threshold
+        denom = int(pred.sum()) + num_pos
+        return 2.0 * int((pred & all_y).sum()) / denom if denom > 0 else 0.0
+
+    if len(all_probs) == 0 or num_pos == 0:
+        return 0.0, 0.5
+
+    # predicting the top-k probabilities as matches, for every k that ends a
+    # run of equal probabilities; any threshold in [probs[k], probs[k-1])
+    # selects exactly the top-k, the midpoint is used
+    order = np.argsort(-all_probs, kind='stable')
+    probs = all_probs[order]
+    tp = np.cumsum(all_y[order])
+    ends = np.flatnonzero(np.append(probs[1:] < probs[:-1], True))
+    k = ends + 1
+    f1 = 2.0 * tp[ends] / (k + num_pos)
+    below_min = probs[-1] - max(probs[-1] / 2, 1e-6)
+    thresholds = (probs + np.append(probs[1:], below_min))[ends] / 2
+
+    # on ties prefer the lowest threshold
+    best = len(f1) - 1 - int(np.argmax(f1[::-1]))
+    return float(f1[best]), float(thresholds[best])
+
+
+def autocast_context(hp):
+    """Return the mixed precision context of the training forward passes
+
+    fp16 with loss scaling on CUDA (--fp16), bfloat16 on CPU or CUDA (--bf16),
+    full precision otherwise.
+    """
+    if hp.fp16 and hp.device == 'cuda':
+        return autocast('cuda')
+    if getattr(hp, 'bf16', False):
+        return autocast('cuda' if hp.device == 'cuda' else 'cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def train_step(train_iter, model, optimizer, scheduler, hp, scaler=None, on_step=None):
     """Perform a single training step
     ...existing docstring...
     """
     criterion = nn.CrossEntropyLoss()
+    # the gradients of grad_accum batches are summed before each update
+    grad_accum = max(getattr(hp, 'grad_accum', 1), 1)
+    num_batches = len(train_iter)
+    optimizer.zero_grad()
     for i, batch in enumerate(train_iter):
-        optimizer.zero_grad()
-
-        if len(batch) == 2:
-            x, y = batch
-            if hp.fp16 and hp.device == 'cuda':
-                with autocast('cuda'):
-                    prediction = model(x)
-                    loss = criterion(prediction, y.to(model.device))
-            else:
-                prediction = model(x)
-                loss = criterion(prediction, y.to(model.device))
-        else:
-            x1, x2, y = batch
-            if hp.fp16 and hp.device == 'cuda':
-                with autocast('cuda'):
-                    prediction = model(x1, x2)
-                    loss = criterion(prediction, y.to(model.device))
+        with autocast_context(hp):
+            if len(batch) == 3:
+                x, mask, y = batch
+                prediction = model(x, mask1=mask)
             else:
-                prediction = model(x1, x2)
-                loss = criterion(prediction, y.to(model.device))
+                x1, x2, mask1, mask2, y = batch
+                prediction = model(x1, x2, mask1, mask2)
+            loss = criterion(prediction, y.to(model.device)) / grad_accum
 
-        if hp.fp16 and hp.device == 'cuda':
+        if scaler is not None:
             scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scaler.update()
         else:
             loss.backward()
-            optimizer.step()
-        scheduler.step()
+
+        if (i + 1) % grad_accum == 0 or i + 1 == num_batches:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer.step()
+            scheduler.step()
+            optimizer.zero_grad()
+            updated = True
+        else:
+            updated = False
+
         if i % 10 == 0:
-            print(f"step: {i}, loss: {loss.item()}")
+            print(f"step: {i}, loss: {loss.item() * grad_accum}")
         del loss
 
+        # on_step runs after every optimizer update and may stop the training
+        if updated and on_step is not None and on_step():
+            return True
+    return False
+
 
 def train(trainset, validset, testset, run_tag, hp):
     """Train and evaluate the model
@@ -163,22 +248,39 @@ def train(trainset, validset, testset, run_tag, hp):
     """
     print(f"Running {hp.device}")
     padder = trainset.pad
-    # create the DataLoaders
-    train_iter = data.DataLoader(dataset=trainset,
-                                 batch_size=hp.batch_size,
-                                 shuffle=True,
-                                 num_workers=0,
-                                 collate_fn=padder)
+    # create the DataLoaders (tokenization and augmentation run in worker
+    # processes when num_workers > 0)
+    num_workers = getattr(hp, 'num_workers', 0)
+    loader_args = {'num_workers': num_workers,
+                   'collate_fn': padder,
+                   'pin_memory': hp.device == 'cuda'}
+    if num_workers > 0:
+        # the parent already ran the batched tokenizer: keep the forked
+        # workers' tokenizers single-threaded
+        os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+        loader_args.update({'persistent_workers': True,
+                            'prefetch_factor': getattr(hp, 'prefetch_factor', 2),
+                            'worker_init_fn': worker_init_fn})
+
+    if getattr(hp, 'group_by_length', False):
+        # batches of similar lengths: less padding per step
+        train_iter = data.DataLoader(dataset=trainset,
+                                     batch_sampler=LengthGroupedSampler(trainset.lengths(),
+                                                                        hp.batch_size),
+                                     **loader_args)
+    else:
+        train_iter = data.DataLoader(dataset=trainset,
+                                     batch_size=hp.batch_size,
+                                     shuffle=True,
+                                     **loader_args)
     valid_iter = data.DataLoader(dataset=validset,
                                  batch_size=hp.batch_size*16,
                                  shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
+                                 **loader_args)
     test_iter = data.DataLoader(dataset=testset,
                                  batch_size=hp.batch_size*16,
                                  shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=padder)
+                                 **loader_args)
 
     # initialize model, optimizer, and LR scheduler
     if hp.device == 'cpu':
@@ -200,7 +302,13 @@ def train(trainset, validset, testset, run_tag, hp):
     if hp.device == 'cpu':
         model = model.cpu()
 
-    num_steps = (len(trainset) // hp.batch_size) * hp.n_epochs
+    if getattr(hp, 'bf16', False) and hp.device == 'cpu' and \
+            not getattr(torch.cpu, '_is_avx512_bf16_supported', lambda: True)():
+        print("Warning: this CPU has no native bfloat16 support, --bf16 may be slower than fp32")
+
+    # one optimizer update every grad_accum batches
+    grad_accum = max(getattr(hp, 'grad_accum', 1), 1)
+    num_steps = -(-len(train_iter) // grad_accum) * hp.n_epochs
     scheduler = get_linear_schedule_with_warmup(optimizer,
                                                 num_warmup_steps=0,
                                                 num_training_steps=num_steps)
@@ -210,38 +318,93 @@ def train(trainset, validset, testset, run_tag, hp):
 
     writer = SummaryWriter(log_dir=hp.logdir)
 
-    best_dev_f1 = best_test_f1 = 0.0
+    # evaluations every eval_steps updates use a fixed subsample of the dev set
+    eval_steps = getattr(hp, 'eval_steps', None)
+    eval_size = getattr(hp, 'eval_size', None)
+    patience = getattr(hp, 'patience', None)
+    eval_iter = valid_iter
+    if eval_steps and eval_size and eval_size < len(validset):
+        indices = np.random.RandomState(getattr(hp, 'run_id', 0)).choice(len(validset), eval_size,
+                                                                         replace=False)
+        eval_iter = data.DataLoader(dataset=data.Subset(validset, np.sort(indices)),
+                                    batch_size=hp.batch_size*16,
+                                    shuffle=False,
+                                    **loader_args)
+
+    state = {'epoch': 0, 'step': 0, 'bad_evals': 0,
+             'best_dev_f1': 0.0, 'best_test_f1': 0.0}
+
+    def run_eval(tag, iterator):
+        """Evaluate on the dev set (the test set only on improvement), return whether to stop"""
+        model.eval()
+        dev_f1, th = evaluate(model, iterator)
+        test_f1 = None
+        if dev_f1 > state['best_dev_f1']:
+            test_f1 = evaluate(model, test_iter, threshold=th)
+            state.update(best_dev_f1=dev_f1, best_test_f1=test_f1, bad_evals=0)
+            if hp.save_model:
+                save_checkpoint(model, optimizer, scheduler, state['epoch'], hp)
+        else:
+            state['bad_evals'] += 1
+        model.train()
+
+        print(f"{tag}: dev_f1={dev_f1}, f1={test_f1}, best_f1={state['best_test_f1']}")
+        return patience is not None and state['bad_evals'] >= patience
+
+    def on_step():
+        state['step'] += 1
+        if eval_steps and state['step'] % eval_steps == 0:
+            return run_eval(f"step {state['step']}", eval_iter)
+        return False
+
     for epoch in range(1, hp.n_epochs+1):
+        state['epoch'] = epoch
         model.train()
-        train_step(train_iter, model, optimizer, scheduler, hp, scaler=scaler)
+        stop = train_step(train_iter, model, optimizer, scheduler, hp,
+                          scaler=scaler, on_step=on_step)
 
         # eval
-        model.eval()
-        dev_f1, th = evaluate(model, valid_iter)
-        test_f1 = evaluate(model, test_iter, threshold=th)
+        if not stop and not eval_steps:
+            stop = run_eval(f"epoch {epoch}", valid_iter)
 
-        if dev_f1 > best_dev_f1:
-            best_dev_f1 = dev_f1
-            best_test_f1 = test_f1
-            if hp.save_model:
-                # create the directory if not exist
-                directory = os.path.join(hp.logdir, hp.task)
-                if not os.path.exists(directory):
-                    os.makedirs(directory)
-
-                # save the checkpoints for each component
-                ckpt_path = os.path.join(hp.logdir, hp.task, 'model.pt')
-                ckpt = {'model': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'scheduler': scheduler.state_dict(),
-                        'epoch': epoch}
-                torch.save(ckpt, ckpt_path)
-
-        print(f"epoch {epoch}: dev_f1={dev_f1}, f1={test_f1}, best_f1={best_test_f1}")
-
-        # logging
-        scalars = {'f1': dev_f1,
-                   't_f1': test_f1}
-        # writer.add_scalars(run_tag, scalars, epoch)
+        if stop:
+            print(f"early stopping at epoch {epoch}: no dev_f1 improvement in {patience} evaluations")
+            break
+    else:
+        # the updates after the last multiple of eval_steps (or all of them
+        # if eval_steps exceeds the number of updates) are evaluated once
+        if eval_steps and state['step'] % eval_steps != 0:
+            run_eval(f"step {state['step']} (final)", eval_iter)
 
     writer.close()
+
+
+def save_checkpoint(model, optimizer, scheduler, epoch, hp):
+    """Save the model to <logdir>/<task>/model.pt
+
+    Args:
+        model (DittoModel): the model
+        optimizer (Optimizer): the optimizer
+        scheduler (LambdaLR): the LR scheduler (None if there is none)
+        epoch (int): the current epoch
+        hp (Namespace): Hyper-parameters; with save_weights_only the
+            optimizer and scheduler states are not saved
+
+    Returns:
+        None
+    """
+    # create the directory if not exist
+    directory = os.path.join(hp.logdir, hp.task)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    # save the checkpoints for each component
+    ckpt_path = os.path.join(hp.logdir, hp.task, 'model.pt')
+    ckpt = {'model': model.state_dict(),
+            'head': model.head,
+            'epoch': epoch}
+    if not getattr(hp, 'save_weights_only', False):
+        ckpt['optimizer'] = optimizer.state_dict()
+        if scheduler is not None:
+            ckpt['scheduler'] = scheduler.state_dict()
+    torch.save(ckpt, ckpt_path)
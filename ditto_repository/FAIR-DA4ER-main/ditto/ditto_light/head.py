@@ -0,0 +1,154 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+from .dataset import pad_sequences
+from .ditto import DittoModel, threshold_f1, save_checkpoint
+from .inference import length_buckets
+
+
+def encode_cls(bert, token_ids, offsets, device='cpu', token_budget=16384, out=None):
+    """Run a (frozen) encoder over tokenized pairs and return the [CLS] embeddings.
+
+    Args:
+        bert (nn.Module): the huggingface encoder
+        token_ids (np.ndarray): the flat token ID's of all pairs
+        offsets (np.ndarray): the offsets of each pair in token_ids
+        device (str, optional): the device of the encoder
+        token_budget (int, optional): max number of padded tokens per forward pass
+        out (np.ndarray, optional): a preallocated (n_pairs, hidden_size) array
+
+    Returns:
+        np.ndarray: the float32 embeddings of shape (n_pairs, hidden_size)
+    """
+    lengths = np.diff(offsets)
+    if out is None:
+        out = np.zeros((len(lengths), bert.config.hidden_size), dtype=np.float32)
+
+    order, ranges = length_buckets(lengths, token_budget)
+    with torch.inference_mode():
+        for start, end in ranges:
+            idx = order[start:end]
+            x, mask = pad_sequences([token_ids[offsets[i]:offsets[i+1]] for i in idx])
+            enc = bert(torch.from_numpy(x).to(device),
+                       attention_mask=torch.from_numpy(mask).to(device))[0][:, 0, :]
+            out[idx] = enc.float().cpu().numpy()
+    return out
+
+
+def cached_cls_embeddings(bert, dataset, lm, cache_dir, device='cpu', token_budget=16384):
+    """Encode a DittoDataset with the frozen encoder once and memory-map the result.
+
+    The cache entry is keyed by the LM name and the token ID's of the
+    dataset, so it does not depend on the seed and is shared by every run
+    on the same data (e.g. the run_id's of the run_all_* scripts).
+
+    Args:
+        bert (nn.Module): the pre-trained (frozen) encoder
+        dataset (DittoDataset): a pre-tokenized dataset
+        lm (str): the language model name
+        cache_dir (str): the cache directory
+        device (str, optional): the device of the encoder
+        token_budget (int, optional): max number of padded tokens per forward pass
+
+    Returns:
+        np.ndarray: the (memory-mapped) float32 embeddings, one row per item
+    """
+    token_ids, offsets = dataset.token_ids, dataset.offsets
+    if token_ids is None:
+        raise ValueError("the embedding cache requires a pre-tokenized DittoDataset")
+
+    sha = hashlib.sha1(('%s|cls|' % lm).encode())
+    sha.update(np.ascontiguousarray(token_ids[:offsets[-1]]).tobytes())
+    sha.update(np.ascontiguousarray(offsets).tobytes())
+    fn = os.path.join(cache_dir, sha.hexdigest() + '.cls.npy')
+
+    if not os.path.exists(fn):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = '%s.%d.tmp' % (fn, os.getpid())
+        out = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=np.float32,
+                                        shape=(len(offsets) - 1, bert.config.hidden_size))
+        encode_cls(bert, token_ids, offsets, device=device, token_budget=token_budget, out=out)
+        out.flush()
+        del out
+        os.replace(tmp_fn, fn)
+
+    return np.load(fn, mmap_mode='r')
+
+
+def train_head(trainset, validset, testset, run_tag, hp):
+    """Train only the classification head on top of the frozen encoder
+
+    The [CLS] embeddings of the three sets are computed once with the
+    pre-trained encoder and cached in hp.cache_dir; every epoch then only
+    runs the head (hp.head_only: linear or mlp) over the cached embeddings.
+    The saved checkpoint is a regular DittoModel checkpoint.
+
+    Args:
+        trainset (DittoDataset): the training set
+        validset (DittoDataset): the validation set
+        testset (DittoDataset): the test set
+        run_tag (str): the tag of the run
+        hp (Namespace): Hyper-parameters (e.g., batch_size, head_lr,
+                        head_only, cache_dir)
+
+    Returns:
+        None
+    """
+    if hp.device == 'cuda' and not torch.cuda.is_available():
+        print("Warning: using CPU, but CUDA is not available")
+        hp.device = 'cpu'
+    if hp.da is not None:
+        print("Warning: data augmentation is ignored when training on cached embeddings")
+
+    model = DittoModel(device=hp.device, lm=hp.lm, head=hp.head_only).to(hp.device)
+    model.bert.eval()
+    for param in model.bert.parameters():
+        param.requires_grad = False
+
+    cache_dir = getattr(hp, 'cache_dir', None) or 'cache/'
+    embeddings = [torch.from_numpy(np.asarray(cached_cls_embeddings(model.bert, dataset, hp.lm,
+                                                                    cache_dir, device=hp.device)))
+                  for dataset in [trainset, validset, testset]]
+    labels = [torch.LongTensor(dataset.labels) for dataset in [trainset, validset, testset]]
+    train_x, valid_x, test_x = [emb.to(hp.device) for emb in embeddings]
+    train_y, valid_y, test_y = [y.to(hp.device) for y in labels]
+
+    def probs(x):
+        with torch.no_grad():
+            return model.fc(x).softmax(dim=1)[:, 1].cpu().numpy()
+
+    optimizer = optim.Adam(model.fc.parameters(), lr=hp.head_lr)
+    criterion = nn.CrossEntropyLoss()
+    patience = getattr(hp, 'patience', None)
+    best_dev_f1 = best_test_f1 = 0.0
+    bad_epochs = 0
+    for epoch in range(1, hp.n_epochs+1):
+        model.fc.train()
+        for batch in torch.randperm(len(train_x)).split(hp.batch_size):
+            optimizer.zero_grad()
+            loss = criterion(model.fc(train_x[batch]), train_y[batch])
+            loss.backward()
+            optimizer.step()
+
+        # eval
+        model.fc.eval()
+        dev_f1, th = threshold_f1(probs(valid_x), valid_y.cpu().numpy())
+        test_f1 = threshold_f1(probs(test_x), test_y.cpu().numpy(), threshold=th)
+
+        if dev_f1 > best_dev_f1:
+            best_dev_f1 = dev_f1
+            best_test_f1 = test_f1
+            bad_epochs = 0
+            if hp.save_model:
+                save_checkpoint(model, optimizer, None, epoch, hp)
+        else:
+            bad_epochs += 1
+
+        print(f"epoch {epoch}: loss={loss.item()}, dev_f1={dev_f1}, f1={test_f1}, best_f1={best_test_f1}")
+        if patience is not None and bad_epochs >= patience:
+            print(f"early stopping at epoch {epoch}: no dev_f1 improvement in {patience} evaluations")
+            break
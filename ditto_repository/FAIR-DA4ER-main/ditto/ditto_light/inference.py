@@ -0,0 +1,272 @@
+import os
+import time
+import tempfile
+import numpy as np
+import torch
+
+from torch import nn
+
+from .dataset import get_tokenizer, batch_encode, pad_sequences
+
+
+def length_buckets(lengths, token_budget):
+    """Sort sequences by length and cut them into batches under a token budget.
+
+    Args:
+        lengths (np.ndarray): the token length of each sequence
+        token_budget (int): max number of (padded) tokens per batch
+
+    Returns:
+        np.ndarray: the positions sorted by length
+        list of (int, int): the [start, end) ranges of each batch in the sorted order
+    """
+    order = np.argsort(lengths, kind='stable')
+    sorted_len = lengths[order]
+    ranges = []
+    start = 0
+    while start < len(order):
+        # sequences are sorted, so the last row of a batch is its longest one
+        window = sorted_len[start:start + token_budget // max(sorted_len[start], 1)]
+        fits = np.arange(1, len(window) + 1) * window <= token_budget
+        end = start + max(int(fits.sum()), 1)
+        ranges.append((start, end))
+        start = end
+    return order, ranges
+
+
+class InferenceEngine:
+    """Length-bucketed batch inference for a trained DittoModel.
+
+    The tokenizer is loaded once. Each call tokenizes the pairs with a single
+    batched tokenizer call, sorts them by token length and runs micro-batches
+    whose padded size (rows x longest sequence) stays within a token budget,
+    so short pairs are never padded to the length of the longest one.
+
+    Args:
+        model (DittoModel): the trained model
+        lm (str, optional): the language model of the tokenizer
+        max_len (int, optional): the max sequence length
+        token_budget (int, optional): max number of (padded) tokens per micro-batch
+    """
+
+    def __init__(self, model, lm='distilbert', max_len=256, token_budget=16384):
+        self.model = model
+        self.tokenizer = get_tokenizer(lm)
+        self.max_len = max_len
+        self.token_budget = max(token_budget, max_len)
+
+    def tokenize(self, sentence_pairs):
+        """Tokenize serialized pairs ("left\tright\tlabel") with batched calls.
+
+        Args:
+            sentence_pairs (list of str): the serialized pairs
+
+        Returns:
+            np.ndarray: the flat int32 token ID's of all pairs
+            np.ndarray: the offsets of each pair in the flat array
+        """
+        lefts, rights = [], []
+        for pair in sentence_pairs:
+            fields = pair.split('\t')
+            lefts.append(fields[0])
+            rights.append(fields[1])
+        return batch_encode(self.tokenizer, lefts, rights, max_len=self.max_len)
+
+    def micro_batches(self, lengths):
+        """Split the length-sorted positions into micro-batches under the token budget.
+
+        Args:
+            lengths (np.ndarray): the token length of each pair
+
+        Returns:
+            np.ndarray: the pair positions sorted by length
+            list of (int, int): the [start, end) ranges of each micro-batch in the sorted order
+        """
+        return length_buckets(lengths, self.token_budget)
+
+    def forward(self, token_ids, offsets):
+        """Run the model over tokenized pairs and return the logits in input order.
+
+        Args:
+            token_ids (np.ndarray): the flat token ID's of all pairs
+            offsets (np.ndarray): the offsets of each pair in token_ids
+
+        Returns:
+            np.ndarray: the logits of shape (n_pairs, 2)
+        """
+        lengths = np.diff(offsets)
+        order, ranges = self.micro_batches(lengths)
+        logits = np.zeros((len(lengths), 2), dtype=np.float32)
+
+        with torch.inference_mode():
+            for start, end in ranges:
+                idx = order[start:end]
+                x, mask = pad_sequences([token_ids[offsets[i]:offsets[i+1]] for i in idx])
+                logits[idx] = self.model(torch.from_numpy(x),
+                                         mask1=torch.from_numpy(mask)).float().cpu().numpy()
+        return logits
+
+    def predict_logits(self, sentence_pairs):
+        """Tokenize and classify serialized pairs.
+
+        Args:
+            sentence_pairs (list of str): the serialized pairs
+
+        Returns:
+            np.ndarray: the logits of shape (n_pairs, 2), in input order
+        """
+        if len(sentence_pairs) == 0:
+            return np.zeros((0, 2), dtype=np.float32)
+        return self.forward(*self.tokenize(sentence_pairs))
+
+
+BACKENDS = ['eager', 'int8', 'torchscript', 'onnx']
+
+
+class _LogitsModule(nn.Module):
+    """Expose DittoModel as a (x, mask) -> logits module for tracing/export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, mask):
+        return self.model(x, mask1=mask)
+
+
+class ScriptedModel:
+    """Call a traced TorchScript module with the DittoModel signature."""
+
+    def __init__(self, module):
+        self.module = module
+
+    def __call__(self, x1, mask1=None):
+        if mask1 is None:
+            mask1 = torch.ones_like(x1)
+        return self.module(x1, mask1)
+
+
+class OnnxModel:
+    """Run an exported Ditto model with onnxruntime on CPU."""
+
+    def __init__(self, path, num_threads=None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("the onnx backend requires onnxruntime (pip install onnxruntime)")
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(path, options,
+                                            providers=['CPUExecutionProvider'])
+
+    def __call__(self, x1, mask1=None):
+        if mask1 is None:
+            mask1 = torch.ones_like(x1)
+        logits = self.session.run(None, {'input_ids': x1.cpu().numpy(),
+                                         'attention_mask': mask1.cpu().numpy()})[0]
+        return torch.from_numpy(logits)
+
+
+def _is_fresh(export_path, checkpoint):
+    """Whether an exported model exists and is newer than its checkpoint."""
+    return os.path.exists(export_path) and \
+        (checkpoint is None or os.path.getmtime(export_path) >= os.path.getmtime(checkpoint))
+
+
+def load_backend(model, backend='eager', num_threads=None, checkpoint=None):
+    """Prepare a trained DittoModel for CPU inference.
+
+    Args:
+        model (DittoModel): the trained model
+        backend (str, optional): one of BACKENDS. ``int8`` applies dynamic int8
+            quantization to the Linear layers, ``torchscript`` and ``onnx``
+            export the model next to the checkpoint (``model.ts``/``model.onnx``)
+            and reuse the export while it is newer than the checkpoint
+        num_threads (int, optional): the number of intra-op threads
+        checkpoint (str, optional): the path of model.pt
+
+    Returns:
+        a callable with the DittoModel signature ``model(x1, mask1=None)``
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend %s, expected one of %s" % (backend, BACKENDS))
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+
+    model.eval()
+    if backend == 'eager':
+        return model
+    if 'cuda' in str(model.device):
+        raise ValueError("the %s backend only runs on CPU" % backend)
+
+    if backend == 'int8':
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    export_dir = os.path.dirname(checkpoint) if checkpoint is not None else tempfile.mkdtemp()
+    wrapper = _LogitsModule(model).eval()
+    example = (torch.ones((2, 16), dtype=torch.long), torch.ones((2, 16), dtype=torch.long))
+
+    if backend == 'torchscript':
+        export_path = os.path.join(export_dir, 'model.ts')
+        if not _is_fresh(export_path, checkpoint):
+            with torch.no_grad():
+                torch.jit.trace(wrapper, example, check_trace=False).save(export_path)
+        return ScriptedModel(torch.jit.load(export_path))
+
+    export_path = os.path.join(export_dir, 'model.onnx')
+    if not _is_fresh(export_path, checkpoint):
+        with torch.no_grad():
+            torch.onnx.export(wrapper, example, export_path,
+                              input_names=['input_ids', 'attention_mask'],
+                              output_names=['logits'],
+                              dynamic_axes={'input_ids': {0: 'batch', 1: 'seq'},
+                                            'attention_mask': {0: 'batch', 1: 'seq'},
+                                            'logits': {0: 'batch'}})
+        model.eval()
+    return OnnxModel(export_path, num_threads=num_threads)
+
+
+def benchmark(model, sentence_pairs, backends=BACKENDS,
+              lm='distilbert', max_len=256, token_budget=16384,
+              num_threads=None, checkpoint=None, tolerance=0.05):
+    """Compare the throughput and the predictions of the inference backends.
+
+    The eager FP32 model is the reference: for every backend report the
+    pairs/s, the max absolute difference of the match probability and the
+    fraction of pairs with the same 0.5-thresholded label.
+
+    Args:
+        model (DittoModel): the trained model
+        sentence_pairs (list of str): the serialized pairs
+        backends (list of str, optional): the backends to run
+        lm (str, optional): the language model
+        max_len (int, optional): the max sequence length
+        token_budget (int, optional): max number of padded tokens per forward pass
+        num_threads (int, optional): the number of intra-op threads
+        checkpoint (str, optional): the path of model.pt (for the exports)
+        tolerance (float, optional): the max allowed probability difference
+
+    Returns:
+        list of dict: one report per backend
+    """
+    reference = None
+    reports = []
+    for backend in ['eager'] + [b for b in backends if b != 'eager']:
+        runner = load_backend(model, backend, num_threads=num_threads, checkpoint=checkpoint)
+        engine = InferenceEngine(runner, lm=lm, max_len=max_len, token_budget=token_budget)
+        start = time.time()
+        logits = engine.predict_logits(sentence_pairs)
+        run_time = time.time() - start
+
+        probs = torch.from_numpy(logits).softmax(dim=1)[:, 1].numpy()
+        if reference is None:
+            reference = probs
+        diff = float(np.abs(probs - reference).max()) if len(probs) else 0.0
+        reports.append({'backend': backend,
+                        'pairs/s': len(sentence_pairs) / run_time,
+                        'max_prob_diff': diff,
+                        'agreement': float(((probs > 0.5) == (reference > 0.5)).mean()) if len(probs) else 1.0,
+                        'within_tolerance': diff <= tolerance})
+    return reports
@@ -10,17 +10,21 @@ import re
 import time
 import argparse
 import sys
-import sklearn
 import traceback
+import multiprocessing as mp
+import queue
+import threading
+
+from collections import deque
 
-from torch.utils import data
 from tqdm import tqdm
 #from apex import amp
 from scipy.special import softmax
 
-from ditto_light.ditto import evaluate, DittoModel
+from ditto_light.ditto import threshold_f1, DittoModel
 from ditto_light.exceptions import ModelNotFoundError
-from ditto_light.dataset import DittoDataset
+from ditto_light.dataset import file_hash
+from ditto_light.inference import InferenceEngine, BACKENDS, load_backend, benchmark
 from ditto_light.summarize import Summarizer
 from ditto_light.knowledge import *
 
@@ -73,7 +77,8 @@ def to_str(ent1, ent2, summarizer=None, max_len=256, dk_injector=None):
 def classify(sentence_pairs, model,
              lm='distilbert',
              max_len=256,
-             threshold=None):
+             threshold=None,
+             engine=None):
     """Apply the MRPC model.
 
     Args:
@@ -81,39 +86,183 @@ def classify(sentence_pairs, model,
         model (MultiTaskNet): the model in pytorch
         max_len (int, optional): the max sequence length
         threshold (float, optional): the threshold of the 0's class
+        engine (InferenceEngine, optional): a reusable inference engine;
+            if not set, a new one (and its tokenizer) is created
 
     Returns:
         list of float: the scores of the pairs
     """
-    inputs = sentence_pairs
-    # print('max_len =', max_len)
-    dataset = DittoDataset(inputs,
-                           max_len=max_len,
-                           lm=lm)
-    # print(dataset[0])
-    iterator = data.DataLoader(dataset=dataset,
-                               batch_size=len(dataset),
-                               shuffle=False,
-                               num_workers=0,
-                               collate_fn=DittoDataset.pad)
-
-    # prediction
-    all_probs = []
-    all_logits = []
-    with torch.no_grad():
-        # print('Classification')
-        for i, batch in enumerate(iterator):
-            x, _ = batch
-            logits = model(x)
-            probs = logits.softmax(dim=1)[:, 1]
-            all_probs += probs.cpu().numpy().tolist()
-            all_logits += logits.cpu().numpy().tolist()
+    if engine is None:
+        engine = InferenceEngine(model, lm=lm, max_len=max_len)
+
+    # prediction (length-bucketed micro-batches, original order restored)
+    all_logits = engine.predict_logits(sentence_pairs)
+    return apply_threshold(all_logits, threshold), all_logits.tolist()
+
+
+def apply_threshold(all_logits, threshold=None):
+    """Turn the logits into 0/1 predictions
+
+    Args:
+        all_logits (np.ndarray): the logits of shape (n_pairs, 2)
+        threshold (float, optional): the threshold of the 0's class
+
+    Returns:
+        list of int: the predictions
+    """
+    all_probs = softmax(all_logits, axis=1)[:, 1]
 
     if threshold is None:
         threshold = 0.5
 
-    pred = [1 if p > threshold else 0 for p in all_probs]
-    return pred, all_logits
+    return [1 if p > threshold else 0 for p in all_probs]
+
+def read_batches(input_path, batch_size=1024, summarizer=None,
+                 max_len=256, dk_injector=None):
+    """Read the candidate pairs and serialize them batch by batch
+
+    Args:
+        input_path (str): the input file path (jsonlines)
+        batch_size (int): the batch size
+        summarizer (Summarizer, optional): the summarization module
+        max_len (int, optional): the max sequence length
+        dk_injector (DKInjector, optional): the domain-knowledge injector
+
+    Yields:
+        list: the input rows of the batch
+        list of str: the serialized pairs of the batch
+    """
+    with jsonlines.open(input_path) as reader:
+        pairs = []
+        rows = []
+        for idx, row in tqdm(enumerate(reader)):
+            pairs.append(to_str(row[0], row[1], summarizer, max_len, dk_injector))
+            rows.append(row)
+            if len(pairs) == batch_size:
+                yield rows, pairs
+                pairs = []
+                rows = []
+
+        if len(pairs) > 0:
+            yield rows, pairs
+
+
+def write_batch(rows, predictions, logits, writer):
+    """Write the predictions of a batch to the jsonlines output"""
+    scores = softmax(logits, axis=1)
+    for row, pred, score in zip(rows, predictions, scores):
+        output = {'left': row[0], 'right': row[1],
+            'match': pred,
+            'match_confidence': float(score[int(pred)])}
+        # carry the stable pair id through, so the output can be joined on ids
+        if len(row) > 2:
+            output['pair_id'] = row[2]
+        writer.write(output)
+
+
+_worker_engine = None
+
+def _init_worker(model_spec, max_len, token_budget):
+    """Load a private copy of the model in a predict worker process"""
+    global _worker_engine
+    torch.set_num_threads(model_spec['num_threads'])
+    _, model = load_model(model_spec['task'], model_spec['checkpoint_path'],
+                          model_spec['lm'], use_gpu=False)
+    checkpoint = os.path.join(model_spec['checkpoint_path'], model_spec['task'], 'model.pt')
+    model = load_backend(model, model_spec['backend'],
+                         num_threads=model_spec['num_threads'],
+                         checkpoint=checkpoint)
+    _worker_engine = InferenceEngine(model, lm=model_spec['lm'],
+                                     max_len=max_len, token_budget=token_budget)
+
+
+def run_pipeline(batches, engine, writer, threshold=None, queue_size=4):
+    """Classify the batches with serialization, inference and writing overlapped
+
+    A producer thread serializes and tokenizes batch N+1 while the model
+    runs batch N, and a writer thread drains the results to the output.
+    The bounded queues between the stages keep at most queue_size batches
+    waiting at each step.
+
+    Args:
+        batches (iterator): the (rows, pairs) batches, e.g. from read_batches
+        engine (InferenceEngine): the inference engine
+        writer (jsonlines.Writer): the output writer
+        threshold (float, optional): the threshold of the 0's class
+        queue_size (int, optional): the capacity of each queue
+
+    Returns:
+        None
+    """
+    token_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(item):
+        """Put on the token queue unless the pipeline was stopped"""
+        while not stop.is_set():
+            try:
+                token_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for rows, pairs in batches:
+                if not put((rows, engine.tokenize(pairs))):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            # close the input reader, also when the model loop stopped early
+            if hasattr(batches, 'close'):
+                batches.close()
+            put(None)
+
+    def drain():
+        while True:
+            item = result_queue.get()
+            if item is None:
+                break
+            # keep consuming after an error, so the model loop never blocks
+            if not errors:
+                try:
+                    write_batch(*item, writer)
+                except Exception as e:
+                    errors.append(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    consumer = threading.Thread(target=drain, daemon=True)
+    producer.start()
+    consumer.start()
+    try:
+        while not errors:
+            item = token_queue.get()
+            if item is None:
+                break
+            rows, (token_ids, offsets) = item
+            logits = engine.forward(token_ids, offsets)
+            result_queue.put((rows, apply_threshold(logits, threshold), logits))
+    finally:
+        # unblock and join the producer before re-raising
+        stop.set()
+        producer.join()
+        result_queue.put(None)
+        consumer.join()
+
+    if errors:
+        raise errors[0]
+
+
+def _classify_worker(pairs, threshold):
+    """Classify one batch in a predict worker process"""
+    return classify(pairs, _worker_engine.model,
+                    threshold=threshold,
+                    engine=_worker_engine)
+
 
 def predict(input_path, output_path, config,
             model,
@@ -122,9 +271,23 @@ def predict(input_path, output_path, config,
             lm='distilbert',
             max_len=256,
             dk_injector=None,
-            threshold=None):
+            threshold=None,
+            token_budget=16384,
+            num_workers=0,
+            model_spec=None,
+            queue_size=4):
     """Run the model over the input file containing the candidate entry pairs
 
+    Each input row may carry a pair id after the two entries (a 4th tab
+    separated column in .txt files, a 3rd element in .jsonl rows); it is
+    copied to the ``pair_id`` field of the corresponding output line.
+
+    With num_workers > 0 the batches are classified by a pool of worker
+    processes, each loading its own model copy from model_spec; at most
+    2 * num_workers batches are in flight and the results are written in
+    input order. Otherwise the batches go through run_pipeline, which
+    overlaps serialization and tokenization with the model forward passes.
+
     Args:
         input_path (str): the input file path
         output_path (str): the output file path
@@ -135,54 +298,56 @@ def predict(input_path, output_path, config,
         max_len (int, optional): the max sequence length
         dk_injector (DKInjector, optional): the domain-knowledge injector
         threshold (float, optional): the threshold of the 0's class
+        token_budget (int, optional): max number of padded tokens per forward pass
+        num_workers (int, optional): the number of worker processes (0: run in process)
+        model_spec (Dictionary, optional): task, checkpoint_path, lm, backend
+            and num_threads (per worker) to load the model in the workers
+        queue_size (int, optional): the capacity of the pipeline queues
 
     Returns:
         None
     """
-    pairs = []
-
-    def process_batch(rows, pairs, writer):
-        predictions, logits = classify(pairs, model, lm=lm,
-                                       max_len=max_len,
-                                       threshold=threshold)
-        # try:
-        #     predictions, logits = classify(pairs, model, lm=lm,
-        #                                    max_len=max_len,
-        #                                    threshold=threshold)
-        # except:
-        #     # ignore the whole batch
-        #     return
-        scores = softmax(logits, axis=1)
-        for row, pred, score in zip(rows, predictions, scores):
-            output = {'left': row[0], 'right': row[1],
-                'match': pred,
-                'match_confidence': score[int(pred)]}
-            writer.write(output)
-
     # input_path can also be train/valid/test.txt
-    # convert to jsonlines
+    # convert to jsonlines (an optional 4th column holds the pair id)
     if '.txt' in input_path:
         with jsonlines.open(input_path + '.jsonl', mode='w') as writer:
             for line in open(input_path):
-                writer.write(line.split('\t')[:2])
+                fields = line.rstrip('\n').split('\t')
+                writer.write(fields[:2] + fields[3:4])
         input_path += '.jsonl'
 
+    batches = read_batches(input_path, batch_size=batch_size,
+                           summarizer=summarizer,
+                           max_len=max_len,
+                           dk_injector=dk_injector)
+
     # batch processing
     start_time = time.time()
-    with jsonlines.open(input_path) as reader,\
-         jsonlines.open(output_path, mode='w') as writer:
-        pairs = []
-        rows = []
-        for idx, row in tqdm(enumerate(reader)):
-            pairs.append(to_str(row[0], row[1], summarizer, max_len, dk_injector))
-            rows.append(row)
-            if len(pairs) == batch_size:
-                process_batch(rows, pairs, writer)
-                pairs.clear()
-                rows.clear()
-
-        if len(pairs) > 0:
-            process_batch(rows, pairs, writer)
+    if num_workers > 0:
+        if model_spec is None:
+            raise ValueError("model_spec is required when num_workers > 0")
+        ctx = mp.get_context('spawn')
+        with ctx.Pool(num_workers,
+                      initializer=_init_worker,
+                      initargs=(model_spec, max_len, token_budget)) as pool, \
+             jsonlines.open(output_path, mode='w') as writer:
+            # ordered writer: batches complete out of order but are written FIFO
+            pending = deque()
+            for rows, pairs in batches:
+                pending.append((rows, pool.apply_async(_classify_worker, (pairs, threshold))))
+                while len(pending) > 2 * num_workers:
+                    rows, result = pending.popleft()
+                    write_batch(rows, *result.get(), writer)
+            while pending:
+                rows, result = pending.popleft()
+                write_batch(rows, *result.get(), writer)
+    else:
+        # the tokenizer is loaded once and reused for every batch
+        engine = InferenceEngine(model, lm=lm, max_len=max_len, token_budget=token_budget)
+        with jsonlines.open(output_path, mode='w') as writer:
+            run_pipeline(batches, engine, writer,
+                         threshold=threshold,
+                         queue_size=queue_size)
 
     run_time = time.time() - start_time
     print(f"⏱️ Tempo Inferenza Ditto: {run_time:.4f}s")
@@ -190,10 +355,41 @@ def predict(input_path, output_path, config,
     os.system('echo %s %f >> log.txt' % (run_tag, run_time))
 
 
+def threshold_settings(config, hp):
+    """The settings a tuned threshold depends on
+
+    Args:
+        config (Dictionary): the task configuration
+        hp (Namespace): the matcher arguments
+
+    Returns:
+        Dictionary: the hashes of the checkpoint and of the validation set,
+            and the serialization and backend settings
+    """
+    checkpoint = os.path.join(hp.checkpoint_path, hp.task, 'model.pt')
+    return {'checkpoint': file_hash(checkpoint),
+            'validset': file_hash(config['validset']),
+            'lm': hp.lm,
+            'max_len': hp.max_len,
+            'summarize': hp.summarize,
+            'dk': hp.dk,
+            'backend': hp.backend}
+
+
 def tune_threshold(config, model, hp):
-    """Tune the prediction threshold for a given model on a validation set"""
+    """Tune the prediction threshold for a given model on a validation set
+
+    The result is stored in threshold.json next to model.pt together with
+    the settings it was tuned with, and reused while they do not change.
+    """
     validset = config['validset']
-    task = hp.task
+    cache_path = os.path.join(hp.checkpoint_path, hp.task, 'threshold.json')
+    settings = threshold_settings(config, hp)
+    if os.path.exists(cache_path) and not getattr(hp, 'retune', False):
+        cached = json.load(open(cache_path))
+        if cached['settings'] == settings:
+            print("threshold =", cached['threshold'], "(cached, f1 = %s)" % cached['f1'])
+            return cached['threshold']
 
     # summarize the sequences up to the max sequence length
     set_seed(123)
@@ -210,46 +406,25 @@ def tune_threshold(config, model, hp):
 
         validset = injector.transform_file(validset)
 
-    # load dev sets
-    valid_dataset = DittoDataset(validset,
-                                 max_len=hp.max_len,
-                                 lm=hp.lm)
-
-    # print(valid_dataset[0])
-
-    valid_iter = data.DataLoader(dataset=valid_dataset,
-                                 batch_size=64,
-                                 shuffle=False,
-                                 num_workers=0,
-                                 collate_fn=DittoDataset.pad)
-
-    # acc, prec, recall, f1, v_loss, th = eval_classifier(model, valid_iter,
-    #                                                     get_threshold=True)
-    f1, th = evaluate(model, valid_iter, threshold=None)
-
-    # verify F1
-    set_seed(123)
-    predict(validset, "tmp.jsonl", config, model,
-            summarizer=summarizer,
-            max_len=hp.max_len,
-            lm=hp.lm,
-            dk_injector=injector,
-            threshold=th)
-
-    predicts = []
-    with jsonlines.open("tmp.jsonl", mode="r") as reader:
-        for line in reader:
-            predicts.append(int(line['match']))
-    os.system("rm tmp.jsonl")
-
+    # a single pass through the inference path used by predict: the F1 at
+    # the tuned threshold is the one predict obtains on the validation set
+    sentence_pairs = []
     labels = []
     with open(validset) as fin:
         for line in fin:
-            labels.append(int(line.split('\t')[-1]))
+            if line.strip():
+                sentence_pairs.append(line.rstrip('\n'))
+                labels.append(int(line.split('\t')[-1]))
+
+    engine = InferenceEngine(model, lm=hp.lm, max_len=hp.max_len,
+                             token_budget=getattr(hp, 'token_budget', 16384))
+    all_probs = softmax(engine.predict_logits(sentence_pairs), axis=1)[:, 1]
+    f1, th = threshold_f1(all_probs.tolist(), labels)
+    th = float(th)
+    print("f1 =", f1)
 
-    real_f1 = sklearn.metrics.f1_score(labels, predicts)
-    print("load_f1 =", f1)
-    print("real_f1 =", real_f1)
+    with open(cache_path, 'w') as fout:
+        json.dump({'threshold': th, 'f1': f1, 'settings': settings}, fout, indent=2)
 
     return th
 
@@ -284,9 +459,8 @@ def load_model(task, path, lm, use_gpu, fp16=True):
     else:
         device = 'cpu'
 
-    model = DittoModel(device=device, lm=lm)
-
     saved_state = torch.load(checkpoint, map_location=lambda storage, loc: storage)
+    model = DittoModel(device=device, lm=lm, head=saved_state.get('head', 'linear'))
     model.load_state_dict(saved_state['model'])
     model = model.to(device)
 
@@ -308,12 +482,41 @@ if __name__ == "__main__":
     parser.add_argument("--dk", type=str, default=None)
     parser.add_argument("--summarize", dest="summarize", action="store_true")
     parser.add_argument("--max_len", type=int, default=256)
+    parser.add_argument("--token_budget", type=int, default=16384)
+    parser.add_argument("--backend", type=str, default='eager', choices=BACKENDS)
+    parser.add_argument("--num_threads", type=int, default=None)
+    parser.add_argument("--benchmark", dest="benchmark", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--queue_size", type=int, default=4)
+    parser.add_argument("--retune", dest="retune", action="store_true")
     hp = parser.parse_args()
 
     # load the models
     set_seed(123)
     config, model = load_model(hp.task, hp.checkpoint_path,
                        hp.lm, hp.use_gpu, hp.fp16)
+    checkpoint = os.path.join(hp.checkpoint_path, hp.task, 'model.pt')
+
+    if hp.benchmark:
+        # compare all the backends against the FP32 model on the test set
+        sentence_pairs = [line.rstrip('\n') for line in open(config['testset']) if line.strip()]
+        reports = benchmark(model, sentence_pairs,
+                            lm=hp.lm,
+                            max_len=hp.max_len,
+                            token_budget=hp.token_budget,
+                            num_threads=hp.num_threads,
+                            checkpoint=checkpoint,
+                            tolerance=hp.tolerance)
+        for report in reports:
+            print("%-12s %10.1f pairs/s  max_prob_diff=%.4f  agreement=%.4f  %s" % (
+                report['backend'], report['pairs/s'], report['max_prob_diff'],
+                report['agreement'], 'OK' if report['within_tolerance'] else 'OUT OF TOLERANCE'))
+        sys.exit(0)
+
+    model = load_backend(model, hp.backend,
+                         num_threads=hp.num_threads,
+                         checkpoint=checkpoint)
 
     summarizer = dk_injector = None
     if hp.summarize:
@@ -328,10 +531,23 @@ if __name__ == "__main__":
     # tune threshold
     threshold = tune_threshold(config, model, hp)
 
+    # worker processes pin their thread count (cores split evenly by default)
+    model_spec = None
+    if hp.num_workers > 0:
+        model_spec = {'task': hp.task,
+                      'checkpoint_path': hp.checkpoint_path,
+                      'lm': hp.lm,
+                      'backend': hp.backend,
+                      'num_threads': hp.num_threads or max(1, os.cpu_count() // hp.num_workers)}
+
     # run prediction
     predict(hp.input_path, hp.output_path, config, model,
             summarizer=summarizer,
             max_len=hp.max_len,
             lm=hp.lm,
             dk_injector=dk_injector,
-            threshold=threshold)
+            threshold=threshold,
+            token_budget=hp.token_budget,
+            num_workers=hp.num_workers,
+            model_spec=model_spec,
+            queue_size=hp.queue_size)
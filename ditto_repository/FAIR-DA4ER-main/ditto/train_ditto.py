@@ -12,7 +12,8 @@ sys.path.insert(0, "Snippext_public")
 from ditto_light.dataset import DittoDataset
 from ditto_light.summarize import Summarizer
 from ditto_light.knowledge import *
-from ditto_light.ditto import train
+from ditto_light.ditto import train, HEADS
+from ditto_light.head import train_head
 
 if __name__=="__main__":
     parser = argparse.ArgumentParser()
@@ -24,15 +25,28 @@ if __name__=="__main__":
     parser.add_argument("--n_epochs", type=int, default=20)
     parser.add_argument("--finetuning", dest="finetuning", action="store_true")
     parser.add_argument("--save_model", dest="save_model", action="store_true")
+    parser.add_argument("--save_weights_only", dest="save_weights_only", action="store_true")
+    parser.add_argument("--patience", type=int, default=None)
+    parser.add_argument("--eval_steps", type=int, default=None)
+    parser.add_argument("--eval_size", type=int, default=None)
     parser.add_argument("--logdir", type=str, default="checkpoints/")
     parser.add_argument("--lm", type=str, default='distilbert')
     parser.add_argument("--fp16", dest="fp16", action="store_true")
+    parser.add_argument("--bf16", dest="bf16", action="store_true")
+    parser.add_argument("--grad_accum", type=int, default=1)
     parser.add_argument("--da", type=str, default=None)
     parser.add_argument("--alpha_aug", type=float, default=0.8)
     parser.add_argument("--dk", type=str, default=None)
     parser.add_argument("--summarize", dest="summarize", action="store_true")
     parser.add_argument("--size", type=int, default=None)
     parser.add_argument("--device", type=str, default='cuda')
+    parser.add_argument("--group_by_length", dest="group_by_length", action="store_true")
+    parser.add_argument("--cache_dir", type=str, default='cache/')
+    parser.add_argument("--no_cache", dest="no_cache", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=0)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument("--head_only", type=str, default=None, choices=HEADS)
+    parser.add_argument("--head_lr", type=float, default=1e-3)
 
     hp = parser.parse_args()
 
@@ -78,22 +92,32 @@ if __name__=="__main__":
         validset = injector.transform_file(validset)
         testset = injector.transform_file(testset)
 
-    # load train/dev/test sets
+    # load train/dev/test sets (tokenized once, then memory-mapped from the cache)
+    cache_dir = None if hp.no_cache else hp.cache_dir
     train_dataset = DittoDataset(trainset,
                                    lm=hp.lm,
                                    max_len=hp.max_len,
                                    size=hp.size,
-                                   da=hp.da)
-    valid_dataset = DittoDataset(validset, lm=hp.lm)
-    test_dataset = DittoDataset(testset, lm=hp.lm)
+                                   da=hp.da,
+                                   cache_dir=cache_dir)
+    valid_dataset = DittoDataset(validset, lm=hp.lm, cache_dir=cache_dir)
+    test_dataset = DittoDataset(testset, lm=hp.lm, cache_dir=cache_dir)
 
 
     # train and evaluate the model
     start_time = time.time()
-    train(train_dataset,
-          valid_dataset,
-          test_dataset,
-          run_tag, 
-          hp)
+    if hp.head_only is not None:
+        # frozen encoder: only the head is trained, on cached [CLS] embeddings
+        train_head(train_dataset,
+                   valid_dataset,
+                   test_dataset,
+                   run_tag,
+                   hp)
+    else:
+        train(train_dataset,
+              valid_dataset,
+              test_dataset,
+              run_tag,
+              hp)
     end_time = time.time()
     print(f"⏱️ Tempo Addestramento Ditto: {end_time - start_time:.4f}s")
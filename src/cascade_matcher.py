@@ -0,0 +1,178 @@
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+
+from pair_utils import encode_pairs
+from evaluation import SCORE_COLUMNS, load_test_gt
+from prepare_ditto_candidates import run_preparation
+from convert_ditto_results_v2 import stream_ditto_matches
+
+# Punteggi economici prodotti dai linker con --save_candidates
+SCORERS = {'rl': 'candidates_rl_{}.csv', 'dedupe': 'candidates_dedupe_{}.csv'}
+
+def load_scored_candidates(path):
+    """ Legge i candidati con punteggio: chiavi int64 delle coppie, id e score. """
+    header = pd.read_csv(path, nrows=0).columns
+    id_cols = ['cl_id', 'us_id'] if 'cl_id' in header else ['id_cl', 'id_us']
+    score_col = next(c for c in SCORE_COLUMNS if c in header)
+    df = pd.read_csv(path, usecols=id_cols + [score_col],
+                     dtype={id_cols[0]: np.int64, id_cols[1]: np.int64, score_col: np.float64})
+    id_cl, id_us = df[id_cols[0]].to_numpy(), df[id_cols[1]].to_numpy()
+    return encode_pairs(id_cl, id_us), id_cl, id_us, df[score_col].to_numpy()
+
+def calibrate_bands(keys, id_cl, id_us, scores, gt_val_path, accept_precision=0.98, max_recall_loss=0.01):
+    """
+    Calibra le soglie della cascata sulla GT di validazione (coppie in scope, come in evaluation.py).
+    - high: la soglia più bassa per cui le coppie con score >= high hanno Precision >= accept_precision
+    - low: la soglia più alta per cui le coppie con score < low perdono al più max_recall_loss dei positivi
+    """
+    val_ids_cl, val_ids_us, val_pos = load_test_gt(gt_val_path)
+    in_scope = np.isin(id_cl, val_ids_cl) & np.isin(id_us, val_ids_us)
+    s = scores[in_scope]
+    y = np.isin(keys[in_scope], val_pos)
+
+    # Auto-accept: precision cumulata per score decrescente (ultima posizione di ogni pari merito)
+    high = np.inf
+    if len(s):
+        order = np.argsort(-s, kind='stable')
+        s_sorted = s[order]
+        precision = np.cumsum(y[order]) / np.arange(1, len(s) + 1)
+        last = np.r_[s_sorted[1:] != s_sorted[:-1], True]
+        feasible = np.flatnonzero(last & (precision >= accept_precision))
+        if len(feasible):
+            high = s_sorted[feasible[-1]]
+
+    # Auto-reject: lo score del (m+1)-esimo positivo più basso, con m positivi sacrificabili
+    low = -np.inf
+    pos_scores = np.sort(s[y])
+    max_lost = int(np.floor(max_recall_loss * len(val_pos)))
+    if len(pos_scores) > max_lost:
+        low = pos_scores[max_lost]
+    low = min(low, high)
+
+    return float(high), float(low), {'val_pairs_in_scope': int(len(s)),
+                                     'val_positives': int(len(val_pos)),
+                                     'val_positives_scored': int(y.sum())}
+
+def one_to_one(matches):
+    """ Raffinamento 1:1 come nei linker: ordina per priorità e score, poi un match per id_cl e per id_us. """
+    matches = matches.sort_values(by=['priority', 'score'], ascending=False, kind='stable')
+    matches = matches.drop_duplicates(subset=['id_cl'], keep='first')
+    matches = matches.drop_duplicates(subset=['id_us'], keep='first')
+    return matches[['id_cl', 'id_us']]
+
+def write_cascade_matches(accepted, ditto_matches, output_path):
+    """
+    Unisce auto-accept e match di Ditto con il vincolo 1:1.
+    Gli auto-accept (Precision >= accept_precision su gt_val) hanno la precedenza e sono ordinati
+    per score del linker; i match della banda seguono, ordinati per confidence di Ditto (P(match)).
+    """
+    accepted = accepted.assign(priority=1)
+    ditto_matches = ditto_matches.rename(columns={'match_confidence': 'score'}).assign(priority=0)
+    matches = one_to_one(pd.concat([accepted, ditto_matches], ignore_index=True))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    matches.to_csv(output_path, index=False)
+    return matches
+
+def route_candidates(scorer='rl', blocking_strategy='B1', accept_precision=0.98, max_recall_loss=0.01):
+    print(f"\n--- CASCADE MATCHER ({scorer}) - STRATEGIA: {blocking_strategy} ---")
+
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidates_path = os.path.join(base_dir, 'data', 'candidates', SCORERS[scorer].format(blocking_strategy))
+    gt_val_path = os.path.join(base_dir, 'data', 'gt', 'gt_val.csv')
+    cascade_dir = os.path.join(base_dir, 'data', 'cascade')
+    os.makedirs(cascade_dir, exist_ok=True)
+
+    if not os.path.exists(candidates_path):
+        print(f"❌ Errore: candidati non trovati in {candidates_path} (lancia il linker con --save_candidates)")
+        return
+    if not os.path.exists(gt_val_path):
+        print(f"❌ Errore: Ground Truth di validazione non trovata in {gt_val_path}")
+        return
+
+    keys, id_cl, id_us, scores = load_scored_candidates(candidates_path)
+    high, low, val_stats = calibrate_bands(keys, id_cl, id_us, scores, gt_val_path,
+                                           accept_precision, max_recall_loss)
+    print(f"Soglie calibrate su gt_val: reject < {low:.4f} <= Ditto < {high:.4f} <= accept")
+
+    # Instradamento: estremi decisi dallo score economico, banda incerta a Ditto
+    accept = scores >= high
+    reject = scores < low
+    band = ~(accept | reject)
+    n = len(scores)
+    routing = {'scorer': scorer, 'blocking': blocking_strategy,
+               'low': low, 'high': high, 'candidates': int(n),
+               'accepted': int(accept.sum()), 'rejected': int(reject.sum()), 'ditto': int(band.sum()),
+               **val_stats}
+
+    tag = f"{scorer}_{blocking_strategy}"
+    accepted_path = os.path.join(cascade_dir, f'accepted_{tag}.csv')
+    band_path = os.path.join(cascade_dir, f'band_{tag}.csv')
+    accepted = pd.DataFrame({'id_cl': id_cl[accept], 'id_us': id_us[accept], 'score': scores[accept]})
+    accepted.to_csv(accepted_path, index=False)
+    pd.DataFrame({'id_cl': id_cl[band], 'id_us': id_us[band]}).to_csv(band_path, index=False)
+    with open(os.path.join(cascade_dir, f'routing_{tag}.json'), 'w') as f:
+        json.dump(routing, f, indent=2)
+    print_routing(routing)
+
+    if not band.any():
+        # Banda vuota: niente da passare a Ditto, la cascata si riduce agli auto-accept
+        output_path = os.path.join(base_dir, 'data', 'results', f'matches_cascade_{tag}.csv')
+        empty = pd.DataFrame({'id_cl': id_cl[band], 'id_us': id_us[band], 'match_confidence': scores[band]})
+        matches = write_cascade_matches(accepted, empty, output_path)
+        print(f"✅ Banda incerta vuota: {len(matches)} match (solo auto-accept) salvati in {output_path}")
+        return
+
+    # Solo la banda incerta viene serializzata per Ditto
+    run_preparation(band_path, f'cascade_{tag}.txt')
+
+def merge_results(scorer='rl', blocking_strategy='B1'):
+    """ Unisce gli auto-accept con i match di Ditto sulla banda in data/results/matches_cascade_*.csv. """
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cascade_dir = os.path.join(base_dir, 'data', 'cascade')
+    tag = f"{scorer}_{blocking_strategy}"
+    jsonl_path = os.path.join(base_dir, 'ditto_repository', 'FAIR-DA4ER-main', 'ditto', 'output', f'matches_cascade_{tag}.jsonl')
+    ditto_matches_path = os.path.join(cascade_dir, f'ditto_matches_{tag}.csv')
+    ditto_scores_path = os.path.join(cascade_dir, f'ditto_scores_{tag}.csv')
+    output_path = os.path.join(base_dir, 'data', 'results', f'matches_cascade_{tag}.csv')
+
+    with open(os.path.join(cascade_dir, f'routing_{tag}.json')) as f:
+        routing = json.load(f)
+    if routing['ditto'] == 0:
+        print(f"Banda incerta vuota: i match sono già stati scritti da 'route' in {output_path}")
+        return
+    if not os.path.exists(jsonl_path):
+        print(f"❌ Errore: predizioni Ditto non trovate in {jsonl_path}")
+        return
+
+    n_pairs, n_matches = stream_ditto_matches(jsonl_path, ditto_matches_path, candidates_path=ditto_scores_path)
+    accepted = pd.read_csv(os.path.join(cascade_dir, f'accepted_{tag}.csv'))
+    # Match di Ditto con la loro P(match), per il raffinamento 1:1
+    ditto_matches = pd.read_csv(ditto_matches_path).merge(pd.read_csv(ditto_scores_path), on=['id_cl', 'id_us'], how='left')
+    matches = write_cascade_matches(accepted, ditto_matches, output_path)
+
+    routing['ditto_matches'] = int(n_matches)
+    print_routing(routing)
+    print(f"✅ Match della cascata (1:1): {len(matches)} ({len(accepted)} auto-accept + {n_matches} Ditto su {n_pairs}, prima del vincolo 1:1)")
+    print(f"Salvato {output_path}")
+
+def print_routing(routing):
+    n = max(routing['candidates'], 1)
+    print(f"Coppie candidate: {routing['candidates']}")
+    for stage in ['accepted', 'rejected', 'ditto']:
+        print(f"  {stage:<9} {routing[stage]:>10}  ({routing[stage] / n:.2%})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cascata: score economico sugli estremi, Ditto solo sulla banda incerta")
+    parser.add_argument("step", choices=['route', 'merge'], help="route: calibra e instrada i candidati; merge: unisce gli auto-accept con i match di Ditto")
+    parser.add_argument("--scorer", choices=list(SCORERS), default='rl', help="Punteggio economico (candidati di record_linkage_rl o dedupe)")
+    parser.add_argument("--blocking", default='B1', help="Blocking strategy (B1 or B2)")
+    parser.add_argument("--accept_precision", type=float, default=0.98, help="Precision minima degli auto-accept su gt_val")
+    parser.add_argument("--max_recall_loss", type=float, default=0.01, help="Frazione massima dei positivi di gt_val scartata dagli auto-reject")
+    args = parser.parse_args()
+    if args.step == 'route':
+        route_candidates(args.scorer, args.blocking, args.accept_precision, args.max_recall_loss)
+    else:
+        merge_results(args.scorer, args.blocking)
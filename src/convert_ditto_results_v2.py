@@ -1,69 +1,135 @@
-import pandas as pd
+import csv
 import json
 import os
 import argparse
 
-def convert_results(strategy):
+from pair_utils import decode_pairs
+
+def iter_positional_ids(csv_path):
+    """Fallback per output Ditto senza pair_id: legge gli id riga per riga dal CSV dei candidati."""
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.DictReader(f)
+        id_cols = ('cl_id', 'us_id') if 'cl_id' in reader.fieldnames else ('id_cl', 'id_us')
+        for row in reader:
+            yield int(float(row[id_cols[0]])), int(float(row[id_cols[1]]))
+
+def stream_ditto_matches(jsonl_path, output_path, ids_csv_path=None, candidates_path=None):
+    """
+    Join in streaming tra le predizioni Ditto e gli id (id_cl, id_us), a memoria costante.
+    Ogni riga di predizione porta il pair_id scritto da prepare_ditto_candidates.py;
+    se manca (output di vecchie versioni) si ricade sull'allineamento posizionale
+    con ids_csv_path, che deve avere esattamente lo stesso numero di righe.
+
+    I CSV sono scritti su file temporanei e rinominati solo a fine passata riuscita,
+    così un errore (es. numero di righe diverso) non lascia file troncati a evaluation.py.
+
+    Returns:
+        (int, int): coppie lette e match scritti
+    """
+    n_pairs = n_matches = 0
+    positional_ids = None
+    tmp_output = f"{output_path}.{os.getpid()}.tmp"
+    tmp_candidates = f"{candidates_path}.{os.getpid()}.tmp" if candidates_path else None
+    completed = False
+
+    cand_file = open(tmp_candidates, 'w', newline='', encoding='utf-8') if candidates_path else None
+    try:
+        with open(jsonl_path, 'r', encoding='utf-8') as fin, \
+             open(tmp_output, 'w', newline='', encoding='utf-8') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(['id_cl', 'id_us'])
+            cand_writer = None
+            if cand_file is not None:
+                cand_writer = csv.writer(cand_file)
+                cand_writer.writerow(['id_cl', 'id_us', 'match_confidence'])
+
+            for line in fin:
+                if not line.strip():
+                    continue
+                pred = json.loads(line)
+
+                if 'pair_id' in pred:
+                    id_cl, id_us = decode_pairs(int(pred['pair_id']))
+                    id_cl, id_us = int(id_cl), int(id_us)
+                else:
+                    if positional_ids is None:
+                        if ids_csv_path is None:
+                            raise ValueError(f"{jsonl_path} has no pair_id and no ids CSV was given")
+                        print("Warning: predictions carry no pair_id, falling back to positional alignment")
+                        positional_ids = iter_positional_ids(ids_csv_path)
+                    try:
+                        id_cl, id_us = next(positional_ids)
+                    except StopIteration:
+                        raise ValueError(f"Line count mismatch: {jsonl_path} has more rows than {ids_csv_path}")
+                n_pairs += 1
+
+                match = int(pred['match'])
+                if match == 1:
+                    writer.writerow([id_cl, id_us])
+                    n_matches += 1
+
+                # match_confidence di Ditto è la confidence della classe predetta: la riportiamo a P(match)
+                if cand_writer is not None:
+                    conf = float(pred['match_confidence'])
+                    cand_writer.writerow([id_cl, id_us, conf if match == 1 else 1.0 - conf])
+
+        if positional_ids is not None and next(positional_ids, None) is not None:
+            raise ValueError(f"Line count mismatch: {ids_csv_path} has more rows than {jsonl_path}")
+        completed = True
+    finally:
+        if cand_file is not None:
+            cand_file.close()
+        if not completed:
+            for tmp in (tmp_output, tmp_candidates):
+                if tmp is not None and os.path.exists(tmp):
+                    os.remove(tmp)
+
+    os.replace(tmp_output, output_path)
+    if candidates_path:
+        os.replace(tmp_candidates, candidates_path)
+    return n_pairs, n_matches
+
+def convert_results(strategy, save_candidates=False):
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    
+
     # Percorsi Input
     csv_path = os.path.join(base_dir, 'data', 'results', f'matches_rl_{strategy}.csv')
     jsonl_path = os.path.join(base_dir, 'ditto_repository', 'FAIR-DA4ER-main', 'ditto', 'output', f'matches_candidates_{strategy}.jsonl')
-    
+
     # Percorso Output
     output_path = os.path.join(base_dir, 'data', 'results', f'matches_ditto_{strategy}.csv')
+    candidates_path = None
+    if save_candidates:
+        # Tutte le coppie con la probabilità di match (per la threshold sweep)
+        candidates_path = os.path.join(base_dir, 'data', 'candidates', f'candidates_ditto_{strategy}.csv')
+        os.makedirs(os.path.dirname(candidates_path), exist_ok=True)
 
     print(f"Converting Ditto results for strategy {strategy}...")
-    print(f"Input CSV (IDs): {csv_path}")
     print(f"Input JSONL (Preds): {jsonl_path}")
 
-    if not os.path.exists(csv_path):
-        print(f"Error: CSV file not found: {csv_path}")
-        return
     if not os.path.exists(jsonl_path):
         print(f"Error: JSONL file not found: {jsonl_path}")
         return
 
-    # 1. Carica IDs dal CSV originale (usato come input per Ditto)
-    df_ids = pd.read_csv(csv_path)
-    
-    # 2. Carica Predizioni da JSONL
-    predictions = []
-    with open(jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            if line.strip():
-                predictions.append(json.loads(line))
-    
-    df_preds = pd.DataFrame(predictions)
-
-    # Controllo allineamento
-    if len(df_ids) != len(df_preds):
-        print(f"Warning: Line count mismatch! CSV: {len(df_ids)}, JSONL: {len(df_preds)}")
-        # Se c'è mismatch, prova a troncare al minimo comune (solitamente Ditto salta righe vuote o errori)
-        min_len = min(len(df_ids), len(df_preds))
-        df_ids = df_ids.iloc[:min_len]
-        df_preds = df_preds.iloc[:min_len]
-        print(f"Truncating to {min_len} lines.")
-
-    # 3. Merge
-    # Assumiamo che l'ordine sia preservato (Dedupe/RL -> txt -> Ditto -> jsonl)
-    df_final = pd.concat([df_ids[['id_cl', 'id_us']].reset_index(drop=True), df_preds[['match', 'match_confidence']].reset_index(drop=True)], axis=1)
-
-    # 4. Filtra i Match (match == 1)
-    df_matches = df_final[df_final['match'] == 1].copy()
-    
-    # Rinomina per coerenza
-    df_matches['confidence'] = df_matches['match_confidence']
-    
-    # 5. Salva
-    cols_to_save = ['id_cl', 'id_us'] # Aggiungi 'confidence' se serve per debug, ma evaluation.py vuole id_cl, id_us
-    df_matches[cols_to_save].to_csv(output_path, index=False)
-    
+    # Il CSV originale serve solo come fallback posizionale per predizioni senza pair_id
+    ids_csv_path = csv_path if os.path.exists(csv_path) else None
+
+    try:
+        n_pairs, n_matches = stream_ditto_matches(jsonl_path, output_path,
+                                                  ids_csv_path=ids_csv_path,
+                                                  candidates_path=candidates_path)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
     print(f"✅ Successo! Salvato {output_path}")
-    print(f"Match trovati: {len(df_matches)} su {len(df_final)} coppie candidate.")
+    if candidates_path:
+        print(f"Saved {n_pairs} scored candidate pairs to {candidates_path}")
+    print(f"Match trovati: {n_matches} su {n_pairs} coppie candidate.")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("strategy", help="Blocking strategy (B1 or B2)")
+    parser.add_argument("--save_candidates", action="store_true", help="Also write all pairs with P(match) to data/candidates/")
     args = parser.parse_args()
-    convert_results(args.strategy)
+    convert_results(args.strategy, save_candidates=args.save_candidates)
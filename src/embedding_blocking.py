@@ -0,0 +1,113 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from pair_utils import encode_pairs
+
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+blocking_code_dir = os.path.join(base_dir, 'ditto_repository', 'FAIR-DA4ER-main', 'ditto', 'blocking')
+sys.path.insert(0, blocking_code_dir)
+
+# Stesse colonne della serializzazione per Ditto (prepare_ditto_candidates.py)
+COLS = ['make', 'model', 'year', 'transmission', 'fuel_type']
+
+def serialize_table(df, cols):
+    """ Serializzazione vettoriale "COL c VAL v ..." (equivalente a serialize() riga per riga). """
+    parts = [("COL " + c + " VAL " + df[c].astype(str).str.strip()).where(df[c].notna(), "COL " + c + " VAL NaN")
+             for c in cols]
+    out = parts[0]
+    for p in parts[1:]:
+        out = out + " " + p
+    return out.tolist()
+
+def write_entries(path, entries):
+    # Una riga per record: encode_all legge il file riga per riga
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(e.replace("\n", " ") for e in entries))
+
+def pair_completeness(id_cl, id_us, gt_path):
+    """ Frazione dei positivi della GT presenti tra i candidati (e quanti). """
+    gt = pd.read_csv(gt_path)
+    gt = gt[gt['label'] == 1] if 'label' in gt.columns else gt
+    gt_keys = np.unique(encode_pairs(gt['id_cl'].to_numpy(), gt['id_us'].to_numpy()))
+    found = int(np.isin(gt_keys, encode_pairs(id_cl, id_us)).sum())
+    return (found / len(gt_keys) if len(gt_keys) else 0.0), found, len(gt_keys)
+
+def embedding_blocking(model_fn, k=10, batch_size=512, overwrite=False, index_type=None, nprobe=None, recall_sample=1000, dtype='float16', target_recall=None):
+    print(f"\n--- EMBEDDING BLOCKING (top-{k}) ---")
+    from blocker import encode_all, blocked_matmul
+    from ann import load_or_build_index, recall_at_k, tune_nprobe
+    from sentence_transformers import SentenceTransformer
+
+    processed_dir = os.path.join(base_dir, 'data', 'processed')
+    blocking_dir = os.path.join(base_dir, 'data', 'blocking')
+    gt_path = os.path.join(base_dir, 'data', 'gt', 'ground_truth.csv')
+    os.makedirs(blocking_dir, exist_ok=True)
+
+    print("Caricamento dataset...")
+    df_cl = pd.read_csv(os.path.join(processed_dir, 'craigslist_final.csv'))
+    df_us = pd.read_csv(os.path.join(processed_dir, 'us_cars_final.csv'))
+
+    # 1. Serializzazione delle due tabelle (riga i del file = id i dell'array)
+    ids_cl = df_cl['id_cl'].to_numpy(dtype=np.int64)
+    ids_us = df_us['id_us'].to_numpy(dtype=np.int64)
+    write_entries(os.path.join(blocking_dir, 'craigslist.txt'), serialize_table(df_cl, COLS))
+    write_entries(os.path.join(blocking_dir, 'us_cars.txt'), serialize_table(df_us, COLS))
+
+    # 2. Encoding con il modello di train_blocker.py (matrici float16/int8 memory-mapped accanto ai file)
+    start_time = time.time()
+    model = SentenceTransformer(model_fn)
+    _, vec_us = encode_all(blocking_dir, 'us_cars.txt', model, overwrite=overwrite, dtype=dtype)
+    _, vec_cl = encode_all(blocking_dir, 'craigslist.txt', model, overwrite=overwrite, dtype=dtype)
+    print(f"⏱️ Tempo Encoding: {time.time() - start_time:.4f}s")
+    if len(vec_us) != len(ids_us) or len(vec_cl) != len(ids_cl):
+        print("❌ Errore: embedding non allineati alle tabelle (rilancia con --overwrite)")
+        return
+
+    # 3. Top-k annunci US più simili per ogni annuncio Craigslist
+    start_time = time.time()
+    index = None
+    if index_type is not None:
+        # Indice ANN sugli embedding US, salvato accanto a us_cars.txt.mat
+        mat_fn = os.path.join(blocking_dir, 'us_cars.txt') + '.mat'
+        index = load_or_build_index(mat_fn, vec_us, index_type, nprobe=nprobe)
+        if target_recall is not None and index_type == 'ivf':
+            # nprobe raddoppiato finché la recall@k sul campione raggiunge il target
+            recall = tune_nprobe(vec_us, vec_cl, index, k, target_recall, sample=recall_sample or 1000)
+            print(f"nprobe scelto: {index.nprobe} (recall@{k} = {recall:.4f})")
+        elif recall_sample > 0:
+            print(f"Recall@{k} dell'indice {index_type} vs matmul esatta: "
+                  f"{recall_at_k(vec_us, vec_cl, index, k, sample=recall_sample):.4f}")
+    idx_us, idx_cl, scores = blocked_matmul(vec_us, vec_cl, k=k, batch_size=batch_size, index=index)
+    print(f"⏱️ Tempo Blocking: {time.time() - start_time:.4f}s")
+
+    candidates = pd.DataFrame({'id_cl': ids_cl[idx_cl], 'id_us': ids_us[idx_us], 'similarity': scores})
+    out_path = os.path.join(blocking_dir, f'candidates_emb_k{k}.csv')
+    candidates.to_csv(out_path, index=False)
+    print(f"Candidate links trovati: {len(candidates)}")
+    print(f"✅ Candidati salvati in: {out_path}")
+
+    # 4. Pair completeness rispetto alla GT e riduzione dello spazio di confronto
+    if os.path.exists(gt_path):
+        pc, found, total = pair_completeness(candidates['id_cl'].to_numpy(), candidates['id_us'].to_numpy(), gt_path)
+        print(f"Pair completeness: {pc:.4f} ({found}/{total} positivi GT tra i candidati)")
+    rr = 1 - len(candidates) / max(len(ids_cl) * len(ids_us), 1)
+    print(f"Reduction ratio: {rr:.6f}")
+    print(f"\nPer Ditto:\n> python src/prepare_ditto_candidates.py {out_path} --output candidates_emb_k{k}.txt")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blocking con embedding (bi-encoder di train_blocker.py) + top-k")
+    parser.add_argument("--model_fn", default=os.path.join(blocking_code_dir, 'model.pth'), help="Modello SentenceTransformer addestrato con train_blocker.py")
+    parser.add_argument("--k", type=int, default=10, help="Numero di annunci US candidati per annuncio Craigslist")
+    parser.add_argument("--batch_size", type=int, default=512)
+    parser.add_argument("--overwrite", action="store_true", help="Ricalcola gli embedding anche se già presenti")
+    parser.add_argument("--index", choices=['ivf', 'hnsw'], default=None, help="Indice ANN al posto della matmul esatta (hnsw richiede faiss-cpu)")
+    parser.add_argument("--nprobe", type=int, default=None, help="Liste IVF visitate per query (default: ~10% delle liste)")
+    parser.add_argument("--target_recall", type=float, default=None, help="Sceglie nprobe (IVF) per raggiungere questa recall@k sul campione")
+    parser.add_argument("--recall_sample", type=int, default=1000, help="Query campionate per la recall@k dell'indice (0: nessun report)")
+    parser.add_argument("--dtype", choices=['float32', 'float16', 'int8'], default='float16', help="Formato di salvataggio degli embedding")
+    args = parser.parse_args()
+    embedding_blocking(args.model_fn, args.k, args.batch_size, args.overwrite, args.index, args.nprobe, args.recall_sample, args.dtype, args.target_recall)
@@ -1,7 +1,184 @@
 import os
+import argparse
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-def evaluate_results():
+from pair_utils import encode_pairs, decode_pairs
+
+# Colonne di punteggio emesse dai linker con --save_candidates (RL, Dedupe, Ditto)
+SCORE_COLUMNS = ['total_score', 'confidence', 'match_confidence']
+
+def load_test_gt(gt_test_path):
+    """ Carica la GT di test: id in scope e chiavi int64 delle coppie positive. """
+    gt_test = pd.read_csv(gt_test_path)
+    
+    # ID inclusi nel test per definire lo "scope" della valutazione
+    test_ids_cl = np.unique(gt_test['id_cl'].to_numpy(dtype=np.int64))
+    test_ids_us = np.unique(gt_test['id_us'].to_numpy(dtype=np.int64))
+
+    # Coppie positive certe (label 1), codificate come chiavi int64
+    gt_pos = gt_test[gt_test['label'] == 1]
+    positives_gt = np.unique(encode_pairs(gt_pos['id_cl'].to_numpy(), gt_pos['id_us'].to_numpy()))
+    return test_ids_cl, test_ids_us, positives_gt
+
+def load_pairs(file_path):
+    """ Legge solo le colonne id di un file di risultato e restituisce le chiavi int64 uniche. """
+    header = pd.read_csv(file_path, nrows=0).columns
+    # Normalizzazione nomi colonne (Dedupe/RL)
+    cols = ['cl_id', 'us_id'] if 'cl_id' in header else ['id_cl', 'id_us']
+    df_res = pd.read_csv(file_path, usecols=cols, dtype={c: np.int64 for c in cols})
+    return np.unique(encode_pairs(df_res[cols[0]].to_numpy(), df_res[cols[1]].to_numpy()))
+
+def evaluate_file(file_path, test_ids_cl, test_ids_us, positives_gt):
+    """ Calcola TP, FP, FN e metriche di un file di risultato (chiavi int64 + np.isin). """
+    # Coppie totali trovate dal modello
+    found_keys = load_pairs(file_path)
+    found_cl, found_us = decode_pairs(found_keys)
+
+    # FILTRO SCOPE: Consideriamo solo i match tra record che fanno parte del Test Set
+    # Questo evita di penalizzare il modello per match corretti "fuori test"
+    in_scope = np.isin(found_cl, test_ids_cl) & np.isin(found_us, test_ids_us)
+    found_pairs = found_keys[in_scope]
+
+    # True Positives: quanti match trovati sono nella lista dei positivi GT
+    tp = int(np.isin(found_pairs, positives_gt, assume_unique=True).sum())
+    
+    # False Positives: tutto ciò che è stato trovato ma non è un TP
+    found_count = len(found_pairs)
+    fp = found_count - tp
+
+    # False Negatives: positivi GT non trovati
+    total_positives_in_gt = len(positives_gt)
+    fn = total_positives_in_gt - tp
+    
+    # Precision = TP / Found
+    precision = tp / found_count if found_count > 0 else 0
+    
+    # Recall = TP / Positivi Totali in GT
+    recall = tp / total_positives_in_gt if total_positives_in_gt > 0 else 0
+    
+    # F1-Score
+    f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
+    
+    return {
+        'Modello': os.path.basename(file_path),
+        'TP': tp,
+        'FP': fp,
+        'FN': fn,
+        'Found': found_count,
+        'Precision': round(precision, 4),
+        'Recall': round(recall, 4),
+        'F1-Score': round(f1, 4)
+    }
+
+def threshold_curve(file_path, test_ids_cl, test_ids_us, positives_gt):
+    """
+    Curva Precision/Recall/F1 completa di un file di candidati con punteggio.
+    Un solo ordinamento per score decrescente + cumsum dei TP: la riga con soglia t
+    descrive i match con score >= t (senza vincolo 1:1).
+    """
+    header = pd.read_csv(file_path, nrows=0).columns
+    id_cols = ['cl_id', 'us_id'] if 'cl_id' in header else ['id_cl', 'id_us']
+    score_col = next(c for c in SCORE_COLUMNS if c in header)
+    df = pd.read_csv(file_path, usecols=id_cols + [score_col],
+                     dtype={id_cols[0]: np.int64, id_cols[1]: np.int64, score_col: np.float64})
+
+    # FILTRO SCOPE sui record del Test Set
+    c, u = df[id_cols[0]].to_numpy(), df[id_cols[1]].to_numpy()
+    in_scope = np.isin(c, test_ids_cl) & np.isin(u, test_ids_us)
+    keys = encode_pairs(c[in_scope], u[in_scope])
+    scores = df[score_col].to_numpy()[in_scope]
+
+    # Coppie duplicate: teniamo lo score più alto
+    order = np.lexsort((-scores, keys))
+    keys, scores = keys[order], scores[order]
+    first = np.r_[True, keys[1:] != keys[:-1]] if len(keys) else np.empty(0, dtype=bool)
+    keys, scores = keys[first], scores[first]
+
+    # Ordinamento unico per score decrescente e conteggi cumulati
+    order = np.argsort(-scores, kind='stable')
+    scores = scores[order]
+    tp = np.cumsum(np.isin(keys, positives_gt, assume_unique=True)[order])
+    found = np.arange(1, len(scores) + 1)
+
+    # A parità di score conta solo l'ultima posizione (la soglia include tutti i pari merito)
+    last = np.r_[scores[1:] != scores[:-1], True] if len(scores) else np.empty(0, dtype=bool)
+    tp, found, thresholds = tp[last], found[last], scores[last]
+
+    total_positives_in_gt = len(positives_gt)
+    precision = tp / found
+    recall = tp / total_positives_in_gt if total_positives_in_gt > 0 else np.zeros(len(tp))
+    f1 = 2 * tp / (found + total_positives_in_gt)
+    return pd.DataFrame({'Threshold': thresholds, 'TP': tp, 'FP': found - tp,
+                         'FN': total_positives_in_gt - tp, 'Found': found,
+                         'Precision': precision, 'Recall': recall, 'F1-Score': f1})
+
+def pick_threshold(curve, min_precision=None):
+    """ Punto operativo dalla curva: F1 massima, oppure Recall massima con Precision >= min_precision. """
+    if min_precision is not None:
+        feasible = curve[curve['Precision'] >= min_precision]
+        if not feasible.empty:
+            return feasible.loc[feasible['Recall'].idxmax()]
+    return curve.loc[curve['F1-Score'].idxmax()]
+
+def sweep_thresholds(max_workers=None, min_precision=None):
+    print("📈 Avvio Threshold Sweep sui candidati con punteggio...")
+
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    candidates_dir = os.path.join(base_dir, 'data', 'candidates')
+    curves_dir = os.path.join(base_dir, 'data', 'results', 'curves')
+    gt_test_path = os.path.join(base_dir, 'data', 'gt', 'gt_test.csv')
+
+    if not os.path.exists(gt_test_path):
+        print(f"❌ Errore: Ground Truth di test non trovata in {gt_test_path}")
+        return
+    if not os.path.isdir(candidates_dir):
+        print(f"❌ Errore: nessun candidato in {candidates_dir} (lancia i linker con --save_candidates)")
+        return
+
+    test_ids_cl, test_ids_us, positives_gt = load_test_gt(gt_test_path)
+    files_to_sweep = [f for f in os.listdir(candidates_dir) if f.endswith('.csv')]
+    os.makedirs(curves_dir, exist_ok=True)
+    sweep_report = []
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(threshold_curve, os.path.join(candidates_dir, f),
+                                   test_ids_cl, test_ids_us, positives_gt): f
+                   for f in files_to_sweep}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                curve = future.result()
+            except Exception as e:
+                print(f"⚠️ Errore su {file_name}: {e}")
+                continue
+            curve.to_csv(os.path.join(curves_dir, file_name.replace('.csv', '_curve.csv')), index=False)
+            if curve.empty:
+                continue
+            best = pick_threshold(curve, min_precision)
+            sweep_report.append({'Modello': file_name,
+                                 'Threshold': best['Threshold'],
+                                 'TP': int(best['TP']),
+                                 'FP': int(best['FP']),
+                                 'Found': int(best['Found']),
+                                 'Precision': round(best['Precision'], 4),
+                                 'Recall': round(best['Recall'], 4),
+                                 'F1-Score': round(best['F1-Score'], 4)})
+
+    if sweep_report:
+        report_df = pd.DataFrame(sweep_report).sort_values(by='F1-Score', ascending=False)
+        print("\n" + "="*80)
+        print("PUNTO OPERATIVO PER MODELLO" + (f" (Precision >= {min_precision})" if min_precision is not None else " (F1 massima)"))
+        print("="*80)
+        print(report_df.to_string(index=False))
+        print("="*80)
+
+        report_path = os.path.join(curves_dir, 'sweep_report.csv')
+        report_df.to_csv(report_path, index=False)
+        print(f"✅ Curve e report salvati in: {curves_dir}")
+
+def evaluate_results(max_workers=None):
     print("📊 Avvio Valutazione Modelli (Versione Corretta)...")
     
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -13,69 +190,25 @@ def evaluate_results():
         return
 
     # 1. Caricamento Ground Truth di Test
-    gt_test = pd.read_csv(gt_test_path)
-    
-    # Set di ID inclusi nel test per definire lo "scope" della valutazione
-    test_ids_cl = set(gt_test['id_cl'].unique())
-    test_ids_us = set(gt_test['id_us'].unique())
-
-    # Coppie positive certe (label 1)
-    positives_gt = set(tuple(x) for x in gt_test[gt_test['label'] == 1][['id_cl', 'id_us']].values)
+    test_ids_cl, test_ids_us, positives_gt = load_test_gt(gt_test_path)
     
     total_positives_in_gt = len(positives_gt)
     print(f"INFO: Ground Truth caricata. Positivi nel Test Set: {total_positives_in_gt}")
 
-    # 2. Iterazione sui file di risultato
+    # 2. Valutazione parallela dei file di risultato
     files_to_evaluate = [f for f in os.listdir(results_dir) if f.endswith('.csv') and f != 'evaluation_report.csv']
     evaluation_report = []
 
-    for file_name in files_to_evaluate:
-        file_path = os.path.join(results_dir, file_name)
-        
-        try:
-            df_res = pd.read_csv(file_path)
-            
-            # Normalizzazione nomi colonne (Dedupe/RL)
-            if 'cl_id' in df_res.columns:
-                df_res = df_res.rename(columns={'cl_id': 'id_cl', 'us_id': 'id_us'})
-            
-            # Coppie totali trovate dal modello
-            found_pairs_all = set(tuple(x) for x in df_res[['id_cl', 'id_us']].values)
-            
-            # FILTRO SCOPE: Consideriamo solo i match tra record che fanno parte del Test Set
-            # Questo evita di penalizzare il modello per match corretti "fuori test"
-            found_pairs = { (c, u) for c, u in found_pairs_all if c in test_ids_cl and u in test_ids_us }
-            
-            # --- CALCOLO METRICHE CORRETTO ---
-            # True Positives: quanti match trovati sono nella lista dei positivi GT
-            tp = len(found_pairs.intersection(positives_gt))
-            
-            # SOTTOLINEATO: False Positives: tutto ciò che è stato trovato ma non è un TP
-            # Questo corregge l'errore dello 0 nella colonna FP
-            found_count = len(found_pairs)
-            fp = found_count - tp
-            
-            # Precision = TP / Found
-            precision = tp / found_count if found_count > 0 else 0
-            
-            # Recall = TP / Positivi Totali in GT
-            recall = tp / total_positives_in_gt if total_positives_in_gt > 0 else 0
-            
-            # F1-Score
-            f1 = 2 * (precision * recall) / (precision + recall) if (precision + recall) > 0 else 0
-            
-            evaluation_report.append({
-                'Modello': file_name,
-                'TP': tp,
-                'FP': fp,
-                'Found': found_count,
-                'Precision': round(precision, 4),
-                'Recall': round(recall, 4),
-                'F1-Score': round(f1, 4)
-            })
-            
-        except Exception as e:
-            print(f"⚠️ Errore su {file_name}: {e}")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(evaluate_file, os.path.join(results_dir, f),
+                                   test_ids_cl, test_ids_us, positives_gt): f
+                   for f in files_to_evaluate}
+        for future in as_completed(futures):
+            file_name = futures[future]
+            try:
+                evaluation_report.append(future.result())
+            except Exception as e:
+                print(f"⚠️ Errore su {file_name}: {e}")
 
     # 3. Visualizzazione e Salvataggio
     if evaluation_report:
@@ -91,4 +224,12 @@ def evaluate_results():
         print(f"✅ Report salvato in: {report_path}")
 
 if __name__ == "__main__":
-    evaluate_results()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Valutazione dei file di risultato in data/results")
+    parser.add_argument("--workers", type=int, default=None, help="Numero di processi paralleli (default: numero di CPU)")
+    parser.add_argument("--sweep", action="store_true", help="Curve P/R/F1 complete sui candidati in data/candidates")
+    parser.add_argument("--min_precision", type=float, default=None, help="Con --sweep: soglia con Recall massima a Precision minima")
+    args = parser.parse_args()
+    if args.sweep:
+        sweep_thresholds(args.workers, args.min_precision)
+    else:
+        evaluate_results(args.workers)
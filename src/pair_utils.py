@@ -0,0 +1,15 @@
+import numpy as np
+
+# Gli id sono indici di riga (< 2^31): una coppia (id_cl, id_us) entra in un int64
+PAIR_KEY_SHIFT = 32
+
+def encode_pairs(id_cl, id_us):
+    """ Codifica le coppie (id_cl, id_us) come chiavi int64 (id_cl << 32 | id_us). """
+    id_cl = np.asarray(id_cl, dtype=np.int64)
+    id_us = np.asarray(id_us, dtype=np.int64)
+    return (id_cl << PAIR_KEY_SHIFT) | id_us
+
+def decode_pairs(keys):
+    """ Operazione inversa di encode_pairs: restituisce (id_cl, id_us). """
+    keys = np.asarray(keys, dtype=np.int64)
+    return keys >> PAIR_KEY_SHIFT, keys & ((1 << PAIR_KEY_SHIFT) - 1)
@@ -1,10 +1,152 @@
 import pandas as pd
+import numpy as np
 import os
-import random
+import argparse
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from sklearn.model_selection import train_test_split
 
-def prepare_linkage_datasets():
-    print("--- PREPARAZIONE DATASET E GROUND TRUTH BILANCIATA ---")
+from pair_utils import encode_pairs, decode_pairs
+
+def sample_negatives(ids_cl, ids_us, pos_keys, num_needed, seed=42, oversample=1.2):
+    """
+    Campionamento vettoriale di coppie negative (label=0) uniche.
+    Le coppie candidate vengono estratte a blocchi con NumPy e i positivi
+    vengono scartati confrontando le chiavi int64 con np.isin.
+    """
+    ids_cl = np.asarray(ids_cl, dtype=np.int64)
+    ids_us = np.asarray(ids_us, dtype=np.int64)
+    pos_keys = np.unique(np.asarray(pos_keys, dtype=np.int64))
+
+    max_negatives = len(ids_cl) * len(ids_us) - len(pos_keys)
+    if num_needed > max_negatives:
+        raise ValueError(f"Richiesti {num_needed} negativi, ma ne esistono al massimo {max_negatives}")
+
+    rng = np.random.default_rng(seed)
+    neg_keys = np.empty(0, dtype=np.int64)
+    while len(neg_keys) < num_needed:
+        # Sovracampioniamo per compensare positivi e duplicati scartati
+        n_draw = int((num_needed - len(neg_keys)) * oversample) + 1024
+        c = ids_cl[rng.integers(0, len(ids_cl), n_draw)]
+        u = ids_us[rng.integers(0, len(ids_us), n_draw)]
+        keys = encode_pairs(c, u)
+        keys = np.concatenate([neg_keys, keys[~np.isin(keys, pos_keys)]])
+
+        # Deduplica mantenendo l'ordine di estrazione (riproducibilità col seed)
+        _, first_idx = np.unique(keys, return_index=True)
+        neg_keys = keys[np.sort(first_idx)]
+
+    neg_cl, neg_us = decode_pairs(neg_keys[:num_needed])
+    return pd.DataFrame({'id_cl': neg_cl, 'id_us': neg_us, 'label': 0})
+
+def mine_hard_negatives(candidates_path, pos_keys, num_needed, seed=42,
+                        weight_floor=0.5, chunksize=5_000_000):
+    """
+    Mining di negativi difficili dalle coppie dei blocchi B1/B2 di record_linkage_rl.
+    Campionamento pesato senza reinserimento (Efraimidis-Spirakis) sul total_score:
+    il file viene letto a blocchi e si mantengono solo le num_needed chiavi migliori.
+    """
+    pos_keys = np.unique(np.asarray(pos_keys, dtype=np.int64))
+    rng = np.random.default_rng(seed)
+
+    best_keys = np.empty(0, dtype=np.int64)
+    best_rank = np.empty(0, dtype=np.float64)
+    reader = pd.read_csv(candidates_path, usecols=['id_cl', 'id_us', 'total_score'],
+                         dtype={'id_cl': np.int64, 'id_us': np.int64, 'total_score': np.float32},
+                         chunksize=chunksize)
+    for chunk in reader:
+        keys = encode_pairs(chunk['id_cl'].to_numpy(), chunk['id_us'].to_numpy())
+        weights = chunk['total_score'].to_numpy(dtype=np.float64) + weight_floor
+
+        is_neg = ~np.isin(keys, pos_keys)
+        keys, weights = keys[is_neg], weights[is_neg]
+
+        # Chiave di estrazione log(U)/w: le coppie con score alto finiscono in cima
+        rank = np.log(rng.random(len(keys))) / weights
+
+        best_keys = np.concatenate([best_keys, keys])
+        best_rank = np.concatenate([best_rank, rank])
+        if len(best_keys) > num_needed:
+            top = np.argpartition(-best_rank, num_needed - 1)[:num_needed]
+            best_keys, best_rank = best_keys[top], best_rank[top]
+
+    # Una stessa coppia può comparire una sola volta tra i candidati del blocking
+    best_keys = np.unique(best_keys)
+    neg_cl, neg_us = decode_pairs(best_keys)
+    return pd.DataFrame({'id_cl': neg_cl, 'id_us': neg_us, 'label': 0})
+
+def pair_components(id_cl, id_us):
+    """
+    Componenti connesse del grafo bipartito delle coppie (id_cl -- id_us).
+    Restituisce, per ogni coppia, l'indice della componente a cui appartiene.
+    """
+    cl_codes, cl_uniques = pd.factorize(np.asarray(id_cl), sort=False)
+    us_codes, us_uniques = pd.factorize(np.asarray(id_us), sort=False)
+    n_nodes = len(cl_uniques) + len(us_uniques)
+
+    # Nodi 0..n_cl-1 per Craigslist, n_cl..n_nodes-1 per US Cars
+    graph = coo_matrix((np.ones(len(cl_codes), dtype=np.int8),
+                        (cl_codes, us_codes + len(cl_uniques))),
+                       shape=(n_nodes, n_nodes))
+    _, node_comp = connected_components(graph, directed=False)
+    return node_comp[cl_codes]
+
+def group_split(gt, fractions=(0.70, 0.15, 0.15), seed=42):
+    """
+    Split train/val/test disgiunto per entità: ogni componente connessa del grafo
+    delle coppie finisce interamente in un solo split, quindi nessun id_cl/id_us
+    è condiviso tra split. La stratificazione sulla label avviene per strato
+    (componenti a maggioranza positiva / negativa) con cumsum + searchsorted.
+    """
+    comp = pair_components(gt['id_cl'].to_numpy(), gt['id_us'].to_numpy())
+    n_comp = comp.max() + 1 if len(comp) else 0
+    comp_size = np.bincount(comp, minlength=n_comp)
+    comp_pos = np.bincount(comp, weights=gt['label'].to_numpy(), minlength=n_comp)
+    comp_stratum = (comp_pos * 2 >= comp_size).astype(np.int8)
+
+    rng = np.random.default_rng(seed)
+    comp_split = np.empty(n_comp, dtype=np.int8)
+    bounds = np.cumsum(fractions)[:-1] / np.sum(fractions)
+    for stratum in (0, 1):
+        members = rng.permutation(np.flatnonzero(comp_stratum == stratum))
+        if len(members) == 0:
+            continue
+        # Taglio sulle coppie cumulate: le proporzioni valgono in numero di coppie
+        cum_pairs = np.cumsum(comp_size[members])
+        cuts = np.searchsorted(cum_pairs, bounds * cum_pairs[-1], side='right')
+        comp_split[members] = np.searchsorted(cuts, np.arange(len(members)), side='right')
+
+    pair_split = comp_split[comp]
+    print(f"Componenti connesse: {n_comp} (la più grande: {comp_size.max() if n_comp else 0} coppie)")
+    return [gt[pair_split == i] for i in range(len(fractions))]
+
+def check_splits(splits, fractions=(0.70, 0.15, 0.15), names=('Train', 'Val', 'Test'),
+                 min_share=0.5, max_pos_gap=0.2):
+    """
+    Stampa dimensione e tasso di positivi di ogni split e lo confronta con la frazione richiesta.
+    Avvisa se uno split ha meno di min_share della sua quota o un tasso di positivi lontano
+    (oltre max_pos_gap) da quello complessivo; False se uno split è vuoto.
+    """
+    total = sum(len(split) for split in splits)
+    overall_pos = sum(split['label'].sum() for split in splits) / total if total else 0.0
+    ok = True
+    for name, split, frac in zip(names, splits, np.asarray(fractions) / np.sum(fractions)):
+        share = len(split) / total if total else 0.0
+        pos_rate = split['label'].mean() if len(split) else 0.0
+        print(f"  {name:<5} {len(split):>8} coppie ({share:.1%}, richiesto {frac:.1%}), positivi {pos_rate:.1%}")
+        if len(split) == 0:
+            print(f"❌ Errore: lo split {name} è vuoto")
+            ok = False
+            continue
+        if share < min_share * frac:
+            print(f"⚠️ Attenzione: lo split {name} è molto sotto la quota richiesta "
+                  f"(una componente connessa troppo grande? prova --split random)")
+        if abs(pos_rate - overall_pos) > max_pos_gap:
+            print(f"⚠️ Attenzione: lo split {name} ha {pos_rate:.1%} di positivi contro {overall_pos:.1%} complessivi")
+    return ok
+
+def prepare_linkage_datasets(neg_ratio=1.0, neg_mode='random', blocking_strategy='B1', split_mode='group'):
+    print(f"--- PREPARAZIONE DATASET E GROUND TRUTH (negativi:positivi = {neg_ratio}:1, negativi {neg_mode}) ---")
     
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     processed_dir = os.path.join(base_dir, 'data', 'processed')
@@ -13,11 +155,11 @@ def prepare_linkage_datasets():
     cl_aligned = os.path.join(processed_dir, 'craigslist_aligned.csv')
     us_aligned = os.path.join(processed_dir, 'us_cars_aligned.csv')
     gt_positive_path = os.path.join(gt_dir, 'ground_truth.csv')
+    candidates_path = os.path.join(base_dir, 'data', 'candidates', f'candidates_rl_{blocking_strategy}.csv')
     
     if not all(os.path.exists(p) for p in [cl_aligned, us_aligned, gt_positive_path]):
         print(f"❌ Errore: Esegui prima generate_gt.py")
         return
-
     df_cl = pd.read_csv(cl_aligned)
     df_us = pd.read_csv(us_aligned)
     gt_pos = pd.read_csv(gt_positive_path)
@@ -33,40 +175,54 @@ def prepare_linkage_datasets():
     df_cl_final.to_csv(os.path.join(processed_dir, 'craigslist_final.csv'), index=False)
     df_us_final.to_csv(os.path.join(processed_dir, 'us_cars_final.csv'), index=False)
 
+    # I candidati per i negativi difficili si ottengono dai file *_final.csv appena scritti
+    if neg_mode == 'hard' and not os.path.exists(candidates_path):
+        print(f"❌ Errore: {candidates_path} mancante. Dataset finali scritti: "
+              f"esegui record_linkage_rl.py --save_candidates e poi rilancia prepare_datasets.py --neg_mode hard")
+        return
+
     # 3. Generazione esempi NEGATIVI (label=0)
-    print("Generazione esempi negativi bilanciati...")
-    pos_pairs = set(zip(gt_pos['id_cl'], gt_pos['id_us']))
-    id_cl_list = df_cl['id_cl'].tolist()
-    id_us_list = df_us['id_us'].tolist()
-    
-    neg_pairs = []
-    num_needed = len(gt_pos)
-    
-    random.seed(42)
-    while len(neg_pairs) < num_needed:
-        c = random.choice(id_cl_list)
-        u = random.choice(id_us_list)
-        if (c, u) not in pos_pairs:
-            neg_pairs.append({'id_cl': c, 'id_us': u, 'label': 0})
-            
-    df_neg = pd.DataFrame(neg_pairs)
+    num_needed = int(round(len(gt_pos) * neg_ratio))
+    print(f"Generazione di {num_needed} esempi negativi...")
+    pos_keys = encode_pairs(gt_pos['id_cl'].to_numpy(), gt_pos['id_us'].to_numpy())
+    if neg_mode == 'hard':
+        df_neg = mine_hard_negatives(candidates_path, pos_keys, num_needed)
+        print(f"Negativi difficili estratti dai blocchi {blocking_strategy}: {len(df_neg)}")
+
+        # Se i blocchi non bastano, completiamo con negativi casuali
+        if len(df_neg) < num_needed:
+            used_keys = np.concatenate([pos_keys, encode_pairs(df_neg['id_cl'], df_neg['id_us'])])
+            df_rand = sample_negatives(df_cl['id_cl'].to_numpy(), df_us['id_us'].to_numpy(),
+                                       used_keys, num_needed - len(df_neg))
+            df_neg = pd.concat([df_neg, df_rand], ignore_index=True)
+    else:
+        df_neg = sample_negatives(df_cl['id_cl'].to_numpy(), df_us['id_us'].to_numpy(), pos_keys, num_needed)
     gt_balanced = pd.concat([gt_pos, df_neg]).sample(frac=1, random_state=42)
     
-    # --- MODIFICA MIGLIORATA: Split Stratificato ---
-    # Lo stratify assicura che Train, Val e Test abbiano tutti il 50% di match e 50% di non-match
-    train_gt, temp_gt = train_test_split(
-        gt_balanced, 
-        test_size=0.30, 
-        random_state=42, 
-        stratify=gt_balanced['label']
-    )
-    val_gt, test_gt = train_test_split(
-        temp_gt, 
-        test_size=0.50, 
-        random_state=42, 
-        stratify=temp_gt['label']
-    )
+    if split_mode == 'group':
+        # Split per componenti connesse: nessun id_cl/id_us condiviso tra Train, Val e Test
+        train_gt, val_gt, test_gt = group_split(gt_balanced)
+    else:
+        # --- MODIFICA MIGLIORATA: Split Stratificato ---
+        # Lo stratify assicura che Train, Val e Test abbiano tutti la stessa proporzione match/non-match
+        train_gt, temp_gt = train_test_split(
+            gt_balanced, 
+            test_size=0.30, 
+            random_state=42, 
+            stratify=gt_balanced['label']
+        )
+        val_gt, test_gt = train_test_split(
+            temp_gt, 
+            test_size=0.50, 
+            random_state=42, 
+            stratify=temp_gt['label']
+        )
     
+    print("Split:")
+    if not check_splits([train_gt, val_gt, test_gt]):
+        print("❌ Split non salvati: usa --split random o riduci --neg_ratio")
+        return
+
     # Salvataggio
     os.makedirs(gt_dir, exist_ok=True)
     train_gt.to_csv(os.path.join(gt_dir, 'gt_train.csv'), index=False)
@@ -76,4 +232,12 @@ def prepare_linkage_datasets():
     print(f"✅ Ground Truth pronta e stratificata (Train: {len(train_gt)}, Val: {len(val_gt)}, Test: {len(test_gt)})")
 
 if __name__ == "__main__":
-    prepare_linkage_datasets()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Prepara dataset e split della Ground Truth")
+    parser.add_argument("--neg_ratio", type=float, default=1.0, help="Rapporto negativi:positivi (default: 1.0)")
+    parser.add_argument("--neg_mode", choices=['random', 'hard'], default='random',
+                        help="'hard' estrae i negativi dai blocchi di record_linkage_rl.py --save_candidates")
+    parser.add_argument("--blocking", default='B1', help="Strategia di blocking per il mining (B1 o B2)")
+    parser.add_argument("--split", choices=['group', 'random'], default='group',
+                        help="'group' tiene ogni id_cl/id_us in un solo split, 'random' è lo split stratificato sulle coppie")
+    args = parser.parse_args()
+    prepare_linkage_datasets(args.neg_ratio, args.neg_mode, args.blocking, args.split)
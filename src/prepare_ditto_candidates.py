@@ -3,6 +3,8 @@ import pandas as pd
 import argparse
 import sys
 
+from pair_utils import encode_pairs
+
 def serialize(row, cols):
     """Formatta la riga: COL [nome] VAL [valore] ..."""
     return " ".join([f"COL {c} VAL {str(row[c]).strip() if pd.notna(row[c]) else 'NaN'}" for c in cols])
@@ -61,8 +63,10 @@ def run_preparation(input_csv, output_name):
         if id_cl in df_cl.index and id_us in df_us.index:
             s1 = serialize(df_cl.loc[id_cl], cols)
             s2 = serialize(df_us.loc[id_us], cols)
-            # 0 è un'etichetta fittizia per l'inferenza
-            lines.append(f"{s1}\t{s2}\t0")
+            # 0 è un'etichetta fittizia per l'inferenza; il pair_id (chiave int64 di id_cl/id_us)
+            # viene riportato da matcher.py nell'output e usato da convert_ditto_results_v2.py per il join
+            pair_id = int(encode_pairs(id_cl, id_us))
+            lines.append(f"{s1}\t{s2}\t0\t{pair_id}")
         else:
             skipped += 1
 
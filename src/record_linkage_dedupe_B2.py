@@ -6,6 +6,7 @@ import dedupe
 import pandas as pd
 import time
 import gc
+import argparse
 import numpy as np
 from tqdm import tqdm
 from dedupe import variables
@@ -14,7 +15,7 @@ from dedupe import variables
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger('dedupe')
 
-def train_dedupe(blocking_strategy='B2'):
+def train_dedupe(blocking_strategy='B2', save_candidates=False):
     print(f"\n--- DEDUPE EXTREME EVOLUTION - STRATEGIA: {blocking_strategy} ---")
     
     # MODIFICA: Imposta a True per forzare l'addestramento e calcolare i tempi
@@ -30,6 +31,7 @@ def train_dedupe(blocking_strategy='B2'):
     output_file = os.path.join(output_dir, f'matches_dedupe_{blocking_strategy}.csv')
     settings_file = os.path.join(model_dir, f'dedupe_settings_{blocking_strategy}.bin')
     training_file = os.path.join(model_dir, f'dedupe_training_{blocking_strategy}.json')
+    candidates_file = os.path.join(base_dir, 'data', 'candidates', f'candidates_dedupe_{blocking_strategy}.csv')
     
     gt_train_path = os.path.join(base_dir, 'data', 'gt', 'gt_train.csv')
     cl_path = os.path.join(base_dir, 'data', 'processed', 'craigslist_final.csv')
@@ -148,6 +150,18 @@ def train_dedupe(blocking_strategy='B2'):
     inference_end = time.time()
     inference_time = inference_end - inference_start
     
+    # Salvataggio opzionale di tutte le coppie del blocking con la confidence (per la threshold sweep)
+    if save_candidates:
+        print("Calcolo confidence su tutte le coppie candidate...")
+        pair_scores = linker.score(linker.pairs(data_1_final, data_2_final))
+        candidates = pd.DataFrame({'id_cl': pair_scores['pairs'][:, 0].astype(np.int64),
+                                   'id_us': pair_scores['pairs'][:, 1].astype(np.int64),
+                                   'confidence': pair_scores['score']})
+        os.makedirs(os.path.dirname(candidates_file), exist_ok=True)
+        candidates.to_csv(candidates_file, index=False)
+        print(f"💾 Candidati con confidence salvati in: {candidates_file} ({len(candidates)} coppie)")
+        del pair_scores, candidates
+
     # 5. RAFFINAMENTO 1:1
     print("Filtraggio 1:1 e salvataggio risultati...")
     df_res = pd.DataFrame([(cl, us, conf) for (cl, us), conf in linked_records], columns=['cl_id', 'us_id', 'confidence'])
@@ -163,4 +177,7 @@ def train_dedupe(blocking_strategy='B2'):
     print(f"⏱️ Tempo Inferenza: {inference_time:.4f}s")
 
 if __name__ == "__main__":
-    train_dedupe('B2')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Record Linkage con Dedupe (B2)")
+    parser.add_argument("--save_candidates", action="store_true", help="Salva tutte le coppie candidate con confidence in data/candidates/")
+    args = parser.parse_args()
+    train_dedupe('B2', save_candidates=args.save_candidates)
@@ -3,14 +3,16 @@ import recordlinkage
 import time
 import os
 import gc
+import argparse
 
-def record_linkage_rules(blocking_strategy='B1'):
+def record_linkage_rules(blocking_strategy='B1', save_candidates=False):
     print(f"\n--- RECORD LINKAGE (RULES) - STRATEGIA: {blocking_strategy} ---")
     
     # Percorsi file
     base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
     processed_dir = os.path.join(base_dir, 'data', 'processed')
     results_dir = os.path.join(base_dir, 'data', 'results')
+    candidates_dir = os.path.join(base_dir, 'data', 'candidates')
     gt_path = os.path.join(base_dir, 'data', 'gt', 'ground_truth.csv')
 
     cl_path = os.path.join(processed_dir, 'craigslist_final.csv')
@@ -70,6 +72,17 @@ def record_linkage_rules(blocking_strategy='B1'):
                                features['fuel'] * 0.5 + 
                                features['transmission'] * 0.5)
     
+    # Salvataggio opzionale di tutte le coppie del blocking con il loro punteggio
+    # (usate per il mining di negativi difficili in prepare_datasets.py)
+    if save_candidates:
+        os.makedirs(candidates_dir, exist_ok=True)
+        cand_path = os.path.join(candidates_dir, f'candidates_rl_{blocking_strategy}.csv')
+        candidates = features[['total_score']].astype('float32').reset_index()
+        candidates.columns = ['id_cl', 'id_us', 'total_score']
+        candidates.to_csv(cand_path, index=False)
+        print(f"💾 Candidati con punteggio salvati in: {cand_path} ({len(candidates)} coppie)")
+        del candidates
+    
     # SOGLIA DI QUALITÀ
     potential_matches = features[features['total_score'] >= 4.5].reset_index()
     potential_matches.rename(columns={'level_0': 'id_cl', 'level_1': 'id_us'}, inplace=True)
@@ -108,5 +121,8 @@ def record_linkage_rules(blocking_strategy='B1'):
     return matches
 
 if __name__ == "__main__":
-    record_linkage_rules('B1')
-    record_linkage_rules('B2')
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Record Linkage basato su regole (B1 e B2)")
+    parser.add_argument("--save_candidates", action="store_true", help="Salva tutte le coppie candidate con total_score in data/candidates/")
+    args = parser.parse_args()
+    record_linkage_rules('B1', save_candidates=args.save_candidates)
+    record_linkage_rules('B2', save_candidates=args.save_candidates)